@@ -1,4 +1,6 @@
-from flask import Flask, render_template, request, jsonify, Response
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
+from flask.json.provider import JSONProvider
+from flask_compress import Compress
 from flask_cors import CORS
 from backend.utils import Model_Prediction, Create_inputs
 import pandas as pd
@@ -9,27 +11,516 @@ from rasterio.transform import from_origin
 import matplotlib.pyplot as plt
 import numpy as np
 import geopandas as gpd
-import json
+import shapely
+from shapely.strtree import STRtree
+import orjson
+import hashlib
 import time
+import zlib
+import queue
 import threading
 import uuid
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from numba import njit
+
+class OrjsonProvider(JSONProvider):
+    """JSON provider backed by orjson: much faster on float-heavy payloads and handles NumPy types."""
+    options = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.options).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)  
 
+# Compress JSON responses (the prediction payload shrinks several times).
+# Only routes decorated with @compress.compressed() are compressed: the SSE stream does its own gzip
+# and must never be encoded a second time.
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 1024
+app.config['COMPRESS_REGISTER'] = False
+compress = Compress(app)
+
+# Load the models at startup so the first request does not pay the unpickling cost
+Model_Prediction.preload_models()
+
 prediction_progress = {}
 
+SSE_HEARTBEAT_SECONDS = 15
+# Messages the SSE worker may queue ahead of a slow client
+SSE_MAX_PENDING = 16
+
+# Background writer for the GeoTIFF outputs, one job per output folder at a time
+_TIFF_POOL = ThreadPoolExecutor(max_workers=2)
+_tiff_jobs = {}
+_tiff_jobs_lock = threading.Lock()
+
+# GeoTIFF output folders (one per set of inputs) kept on disk; the least recently used go first
+OUTPUT_ROOT = 'Data/Output'
+MAX_OUTPUT_DIRS = 32
+
 
 def send_sse_event(event_type, data):
     """Format a Server-Sent Event message."""
-    return f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+    return f"event: {event_type}\ndata: {app.json.dumps(data)}\n\n"
+
+
+def stream_json(payload, stream_key='predictions_by_duration'):
+    """
+    Serialize a prediction payload as a stream of JSON chunks.
+    `payload[stream_key]` is written one duration at a time, so the response starts going out
+    before the whole document is encoded and the full JSON string is never held in memory.
+    """
+    dumps = app.json.dumps
+
+    yield '{'
+    for i, (key, value) in enumerate(payload.items()):
+        yield (',' if i else '') + dumps(str(key)) + ':'
+        if key != stream_key:
+            yield dumps(value)
+            continue
+
+        yield '{'
+        for j, (dur, rows) in enumerate(value.items()):
+            yield (',' if j else '') + dumps(str(dur)) + ':[' + ','.join(map(dumps, rows)) + ']'
+        yield '}'
+    yield '}'
+
+
+def sse_with_heartbeat(events, interval=SSE_HEARTBEAT_SECONDS):
+    """
+    Produce SSE messages in a worker thread and relay them.
+    A keepalive comment is sent whenever no message arrives for `interval` seconds,
+    so browsers and proxies don't drop the connection during long stages (e.g. ERA5 downloads).
+    If the client disconnects, the worker stops at the next message instead of running the
+    rest of the pipeline for nobody; the queue is bounded so it can never pile up messages.
+    """
+    messages = queue.Queue(maxsize=SSE_MAX_PENDING)
+    done = object()
+    stop = threading.Event()
+
+    def put(message):
+        # Wait for room in the queue, unless the client has gone away
+        while not stop.is_set():
+            try:
+                messages.put(message, timeout=interval)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for event in events:
+                if not put(event):
+                    break
+        finally:
+            events.close()
+            put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    try:
+        while True:
+            try:
+                event = messages.get(timeout=interval)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            if event is done:
+                return
+            yield event
+    finally:
+        # Normal end, or GeneratorExit when Flask closes the response on disconnect
+        stop.set()
+
+
+def gzip_sse_stream(events):
+    """
+    Gzip a stream of SSE messages.
+    Each message is sync-flushed so the browser can decode it as soon as it arrives.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for event in events:
+        yield compressor.compress(event.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
 
 
 @app.route('/')
+@compress.compressed()
 def index():
     return render_template('index.html')
 
 
+MASTER_FILE = "Data/Master_Table.nc"
+PORTUGAL_CELLS_FILE = 'backend/utils/Data/Portugal_cells.gpkg'
+
+# Columns that must hold data for a cached Master Table slice to be reused
+CHECK_COLS = ['fuel_load', 'pct_3_8', 'pct_8p',
+              'FWI_12h', 'log_pred', 'linear_pred',
+              'error_estimate', 'log_pred_linear', 'linear_pred_linear']
+
+INPUT_VAR_COLS = ['fuel_load', 'pct_3_8', 'pct_8p', 'wv100_kh', 'FWI_12h', 'DC_12h', 'Cape', 'HDW', 'wv_850', 'gT_8_7']
+
+
+def _parse_inputs(datetime_str, duration):
+    """
+    Validate the request parameters and return the rounded start time.
+    Raises ValueError with a user-facing message if the inputs are invalid.
+    """
+    if not datetime_str:
+        raise ValueError('Missing datetime parameter')
+
+    if duration > 24:
+        raise ValueError('Duration cannot exceed 24 hours.')
+
+    start_time = pd.to_datetime(datetime_str)
+
+    # Date constraints
+    MIN_DATE = pd.Timestamp('2015-01-01')
+    three_months_ago = pd.Timestamp.now() - pd.DateOffset(months=3)
+
+    if not (MIN_DATE <= start_time <= three_months_ago):
+        raise ValueError(f'Date must be between January 1st, 2015 and {three_months_ago.date()}.')
+
+    return start_time.round('30min')
+
+
+def _master_mtime():
+    """
+    Modification time of the Master Table, used to invalidate the in-memory caches.
+    Read under the Master Table lock, so a background write still in progress is waited for
+    and the returned version already includes it.
+    """
+    with Model_Prediction.MASTER_LOCK:
+        try:
+            return os.path.getmtime(MASTER_FILE)
+        except FileNotFoundError:
+            return None
+
+
+@lru_cache(maxsize=1)
+def _load_master(master_mtime):
+    """Load the Master Table into memory once per version of the file on disk."""
+    if master_mtime is None:
+        return None
+    # The pipeline appends to the file in place, so never read it mid-write
+    with Model_Prediction.MASTER_LOCK, xr.open_dataset(MASTER_FILE) as ds:
+        return ds.load()
+
+
+@lru_cache(maxsize=64)
+def _has_cached_inputs(start_time, duration, mins_since_fire_start, master_mtime):
+    """Check whether the Master Table already holds data for every requested duration."""
+    ds_master = _load_master(master_mtime)
+    if ds_master is None:
+        return False
+
+    # One selection for all durations; each duration needs at least one value in CHECK_COLS
+    try:
+        ds_slice = ds_master[CHECK_COLS].sel(
+            s_time=start_time,
+            duration_hours=list(range(1, duration + 1)),
+            fstart=mins_since_fire_start
+        )
+    except KeyError:
+        return False
+
+    has_data = ds_slice.to_array().notnull()
+    has_data = has_data.any(dim=[d for d in has_data.dims if d != 'duration_hours'])
+    return bool(has_data.all())
+
+
+@lru_cache(maxsize=1)
+def _portugal_cells_tree():
+    """Spatial index over the Portugal cells (EPSG:4326), built once per process."""
+    portugal_cells = gpd.read_file(PORTUGAL_CELLS_FILE).to_crs('EPSG:4326')
+    return STRtree(portugal_cells.geometry.values)
+
+
+@lru_cache(maxsize=8)
+def _load_model_inputs(start_time, duration, mins_since_fire_start, master_mtime):
+    """Slice the requested inputs from the Master Table and keep only Portugal cells."""
+    return _slice_model_inputs(_load_master(master_mtime), start_time, duration, mins_since_fire_start)
+
+
+def _slice_model_inputs(ds, start_time, duration, mins_since_fire_start):
+    """Slice the requested inputs from a Master Table dataset and keep only Portugal cells."""
+    model_inputs = ds.sel(
+        s_time=start_time,
+        duration_hours=slice(1, duration),
+        fstart=mins_since_fire_start
+    ).to_dataframe().reset_index()
+
+    # float32 is plenty for predictions and weather/fuel inputs and halves the bytes moved downstream.
+    # Coordinates stay float64: they are used as keys and are sent to the browser as-is.
+    value_cols = [
+        c for c in model_inputs.columns
+        if c not in ('latitude', 'longitude') and model_inputs[c].dtype == np.float64
+    ]
+    model_inputs[value_cols] = model_inputs[value_cols].astype(np.float32)
+
+    model_inputs = model_inputs.dropna(subset=CHECK_COLS, how='all')
+
+    # Filter to Portugal cells
+    points = shapely.points(model_inputs['longitude'].to_numpy(), model_inputs['latitude'].to_numpy())
+    point_idx, _ = _portugal_cells_tree().query(points, predicate='intersects')
+    mask = np.zeros(len(points), dtype=bool)
+    mask[point_idx] = True
+    return model_inputs[mask]
+
+
+@njit(cache=True, fastmath=True)
+def _build_arrays(pred, dur):
+    """Displacement and fallback error estimate (10% of ROS) for each valid cell."""
+    displacement = np.empty_like(pred)
+    error_estimate = np.empty_like(pred)
+    for i in range(pred.shape[0]):
+        displacement[i] = pred[i] * dur[i]
+        error_estimate[i] = pred[i] * 0.1
+    return displacement, error_estimate
+
+
+def _increments(values, latitude, longitude, durations, duration_list):
+    """
+    Change of `values` with respect to the previous duration in `duration_list`, per cell.
+    A cell without a value in the previous duration counts as 0.
+    """
+    wide = pd.DataFrame({
+        'latitude': latitude, 'longitude': longitude, 'duration_hours': durations, 'value': values
+    }).pivot(index=['latitude', 'longitude'], columns='duration_hours', values='value')
+    wide = wide.reindex(columns=duration_list)
+
+    steps = (wide - wide.shift(1, axis=1).fillna(0)).to_numpy()
+    rows = wide.index.get_indexer(pd.MultiIndex.from_arrays([latitude, longitude]))
+    cols = np.searchsorted(duration_list, durations)
+    return steps[rows, cols]
+
+
+@lru_cache(maxsize=4)
+def _compute_predictions(start_time, duration, mins_since_fire_start, model_type, master_mtime):
+    """
+    Build the prediction payload for one set of inputs.
+    Pure with respect to its arguments, so repeat requests are served from the cache
+    until the Master Table changes on disk.
+    Each payload holds every cell x duration as Python objects (tens to hundreds of MB for long
+    runs), so only the last few are kept; the compact inputs stay cached in _load_model_inputs.
+    """
+    model_inputs = _load_model_inputs(start_time, duration, mins_since_fire_start, master_mtime)
+    return _predictions_payload(model_inputs, model_type)
+
+
+def _predictions_payload(model_inputs, model_type):
+    """Prediction payload (per-duration cells, increments and input variables) for sliced model inputs."""
+    pred_col = 'linear_pred' if model_type == 'complex' else 'linear_pred_linear'
+    error_col = 'error_estimate' if model_type == 'complex' else 'error_estimate_linear'
+
+    duration_list = [int(dur) for dur in sorted(model_inputs['duration_hours'].unique())]
+    predictions_by_duration = {dur: [] for dur in duration_list}
+    total_cells = len(model_inputs)
+
+    if pred_col in model_inputs.columns:
+        valid = model_inputs[model_inputs[pred_col].notna()]
+    else:
+        valid = model_inputs.iloc[0:0]
+    successful_cells = len(valid)
+
+    # Whole-grid arrays, computed once for every duration
+    latitude = valid['latitude'].to_numpy(dtype=np.float64)
+    longitude = valid['longitude'].to_numpy(dtype=np.float64)
+    durations = valid['duration_hours'].to_numpy(dtype=np.int64)
+    pred = valid[pred_col].to_numpy(dtype=np.float64) if successful_cells else np.empty(0)
+
+    displacement, error_estimate = _build_arrays(pred, durations.astype(np.float64))
+    if error_col in valid.columns:
+        error_estimate = valid[error_col].to_numpy(dtype=np.float64)
+
+    increment = _increments(displacement, latitude, longitude, durations, duration_list)
+    ros_increment = _increments(pred, latitude, longitude, durations, duration_list)
+
+    # Input variables as JSON-ready columns: non-finite values become None, missing columns all None
+    input_var_values = []
+    for col in INPUT_VAR_COLS:
+        if col in valid.columns:
+            values = valid[col].to_numpy(dtype=np.float64)
+            input_var_values.append(np.where(np.isfinite(values), values, None))
+        else:
+            input_var_values.append(np.full(successful_cells, None, dtype=object))
+
+    for dur in duration_list:
+        rows = durations == dur
+        input_vars = [
+            dict(zip(INPUT_VAR_COLS, row_vals))
+            for row_vals in zip(*(values[rows].tolist() for values in input_var_values))
+        ]
+        predictions_by_duration[dur] = [
+            {
+                'lat': lat,
+                'lon': lon,
+                'ros': ros,
+                'displacement': disp,
+                'error_estimate': err,
+                'input_vars': row_vars,
+                'increment': inc,
+                'ros_increment': ros_inc
+            }
+            for lat, lon, ros, disp, err, row_vars, inc, ros_inc in zip(
+                latitude[rows].tolist(),
+                longitude[rows].tolist(),
+                pred[rows].tolist(),
+                displacement[rows].tolist(),
+                error_estimate[rows].tolist(),
+                input_vars,
+                increment[rows].tolist(),
+                ros_increment[rows].tolist()
+            )
+        ]
+
+    return {
+        'success': True,
+        'predictions_by_duration': predictions_by_duration,
+        'durations': duration_list,
+        'total_cells': total_cells,
+        'successful_cells': successful_cells,
+        'input_var_names': INPUT_VAR_COLS
+    }
+
+
+def _evict_tiff_outputs(keep_dir):
+    """
+    Delete the least recently used output folders beyond MAX_OUTPUT_DIRS (by folder mtime).
+    `keep_dir` and folders whose TIFFs are still being written are never removed.
+    Called with _tiff_jobs_lock held.
+    """
+    try:
+        entries = [entry for entry in os.scandir(OUTPUT_ROOT) if entry.is_dir()]
+    except FileNotFoundError:
+        return
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+
+    for entry in entries[MAX_OUTPUT_DIRS:]:
+        path = f'{OUTPUT_ROOT}/{entry.name}'
+        job = _tiff_jobs.get(path)
+        if path == keep_dir or (job is not None and not job.done()):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        _tiff_jobs.pop(path, None)
+
+
+def _submit_tiff_outputs(df_slice, max_duration, input_var_cols, output_dir, master_mtime):
+    """
+    Queue _generate_tiff_outputs on the TIFF pool, unless that folder is already being written.
+    The folder is marked as just used, and old folders are evicted so the disk use stays bounded.
+    """
+    with _tiff_jobs_lock:
+        if os.path.isdir(output_dir):
+            os.utime(output_dir)
+        _evict_tiff_outputs(output_dir)
+
+        job = _tiff_jobs.get(output_dir)
+        if job is not None and not job.done():
+            return job
+        job = _TIFF_POOL.submit(_generate_tiff_outputs, df_slice, max_duration, input_var_cols, output_dir, master_mtime)
+        job.add_done_callback(_report_tiff_error)
+        _tiff_jobs[output_dir] = job
+        return job
+
+
+def _report_tiff_error(job):
+    if job.exception() is not None:
+        print(f"Error generating TIFF outputs: {job.exception()}")
+
+
+def _run_prediction(start_time, duration, mins_since_fire_start, model_type):
+    """
+    Run the prediction pipeline, yielding (event_type, data) tuples.
+    Progress events are yielded as each stage starts; the last event is 'complete'
+    with the full prediction payload.
+    """
+    # --- Check Master Table ---
+    yield 'progress', {
+        'stage': 'checking_cache',
+        'message': 'Checking cache...',
+        'detail': 'Looking for existing data'
+    }
+
+    # --- Fetch or Calculate Data ---
+    ds_new = None
+    if _has_cached_inputs(start_time, duration, mins_since_fire_start, _master_mtime()):
+        yield 'progress', {
+            'stage': 'loading_cache',
+            'message': 'Loading cached data...',
+            'detail': 'Data found in Master Table'
+        }
+    else:
+        # Need to calculate new data - this is where the main work happens
+        yield 'progress', {
+            'stage': 'fetching_era5_sl',
+            'message': 'Fetching ERA5_SL...',
+            'detail': 'Surface level weather data'
+        }
+
+        # Small delay to allow frontend to render (the actual fetch happens in calculate_and_append_master)
+        time.sleep(0.1)
+
+        yield 'progress', {
+            'stage': 'fetching_era5_fwi',
+            'message': 'Fetching ERA5 Data...',
+            'detail': 'This may take up to 1 minute'
+        }
+
+        # Note: Ideally, Model_Prediction would accept a callback for progress updates
+        # The Master Table write continues in the background; the response is built from the new slice
+        ds_new = Model_Prediction.calculate_and_append_master(
+            start_time, duration, mins_since_fire_start, background=True
+        )
+
+        yield 'progress', {
+            'stage': 'processing',
+            'message': 'Processing grid...',
+            'detail': 'Computing predictions'
+        }
+
+    # --- Build Response ---
+    yield 'progress', {
+        'stage': 'building_response',
+        'message': 'Building response...',
+        'detail': 'Filtering and organizing predictions'
+    }
+
+    if ds_new is None:
+        master_mtime = _master_mtime()
+        model_inputs = _load_model_inputs(start_time, duration, mins_since_fire_start, master_mtime)
+        result = _compute_predictions(start_time, duration, mins_since_fire_start, model_type, master_mtime)
+    else:
+        # Not on disk yet: no Master Table version to cache against, and the TIFFs are always written
+        master_mtime = None
+        model_inputs = _slice_model_inputs(ds_new, start_time, duration, mins_since_fire_start)
+        result = _predictions_payload(model_inputs, model_type)
+
+    # One output folder per set of inputs, so repeat requests reuse the files already written
+    signature = hashlib.blake2b(
+        f"{start_time}:{duration}:{mins_since_fire_start}:{model_type}".encode(), digest_size=8
+    ).hexdigest()
+    output_dir = f'{OUTPUT_ROOT}/{signature}'
+
+    # TIFFs are only needed for later download: write them in the background and answer right away
+    pred_col = 'linear_pred' if model_type == 'complex' else 'linear_pred_linear'
+    df_slice = model_inputs.copy()
+    if pred_col in df_slice.columns:
+        df_slice['linear_pred_smoothed'] = df_slice[pred_col]
+        _submit_tiff_outputs(df_slice, duration, INPUT_VAR_COLS, output_dir, master_mtime)
+
+    yield 'complete', dict(result, output_dir=output_dir)
+
+
 @app.route('/api/predict-grid-sse', methods=['GET'])
 def predict_grid_sse():
     """
@@ -41,6 +532,8 @@ def predict_grid_sse():
     model_type = request.args.get('model', 'complex')
     mins_since_fire_start = int(request.args.get('f_start', 0))
     duration = int(request.args.get('duration_p', 1))
+    # Parsed header: honours q-values (gzip;q=0 means no) and only matches the gzip token
+    use_gzip = request.accept_encodings['gzip'] > 0
     
     def generate():
         try:
@@ -50,267 +543,49 @@ def predict_grid_sse():
                 'message': 'Validating inputs...',
                 'detail': 'Checking parameters'
             })
-            
-            if not datetime_str:
-                yield send_sse_event('error', {'message': 'Missing datetime parameter'})
-                return
-            
-            if duration > 24:
-                yield send_sse_event('error', {'message': 'Duration cannot exceed 24 hours.'})
-                return
-            
-            # Parse and round start time
-            start_time = pd.to_datetime(datetime_str)
-            
-            # Date constraints
-            MIN_DATE = pd.Timestamp('2015-01-01')
-            three_months_ago = pd.Timestamp.now() - pd.DateOffset(months=3)
-            
-            if not (MIN_DATE <= start_time <= three_months_ago):
-                yield send_sse_event('error', {
-                    'message': f'Date must be between January 1st, 2015 and {three_months_ago.date()}.'
-                })
+
+            try:
+                start_time = _parse_inputs(datetime_str, duration)
+            except ValueError as e:
+                yield send_sse_event('error', {'message': str(e)})
                 return
-            
-            start_time = start_time.round('30min')
-            
-            # --- Check Master Table ---
-            yield send_sse_event('progress', {
-                'stage': 'checking_cache',
-                'message': 'Checking cache...',
-                'detail': 'Looking for existing data'
-            })
-            
-            master_file = "Data/Master_Table.nc"
-            ds_master = None
-            
-            if os.path.exists(master_file):
-                with xr.open_dataset(master_file) as ds:
-                    ds_master = ds.load()
-            
-            # Check if data exists
-            data_exists = False
-            cols_to_check = ['fuel_load', 'pct_3_8', 'pct_8p', 
-                 'FWI_12h', 'log_pred', 'linear_pred', 
-                 'error_estimate', 'log_pred_linear', 'linear_pred_linear']
-            
-            if ds_master is not None:
-                valid = True
-                for dur in range(1, duration + 1):
-                    try:
-                        df_slice = ds_master.sel(
-                            s_time=start_time,
-                            duration_hours=dur,
-                            fstart=mins_since_fire_start
-                        ).to_dataframe().reset_index()
-                        
-                        if not df_slice[cols_to_check].notna().any().any():
-                            valid = False
-                            break
-                    except KeyError:
-                        valid = False
-                        break
-                
-                data_exists = valid
-            
-            # --- Fetch or Calculate Data ---
-            if data_exists:
-                yield send_sse_event('progress', {
-                    'stage': 'loading_cache',
-                    'message': 'Loading cached data...',
-                    'detail': 'Data found in Master Table'
-                })
-                
-                model_inputs = ds_master.sel(
-                    s_time=start_time,
-                    duration_hours=slice(1, duration),
-                    fstart=mins_since_fire_start
-                ).to_dataframe().reset_index()
-            else:
-                # Need to calculate new data - this is where the main work happens
-                yield send_sse_event('progress', {
-                    'stage': 'fetching_era5_sl',
-                    'message': 'Fetching ERA5_SL...',
-                    'detail': 'Surface level weather data'
-                })
-                
-                # Small delay to allow frontend to render (the actual fetch happens in calculate_and_append_master)
-                time.sleep(0.1)
-                
-                yield send_sse_event('progress', {
-                    'stage': 'fetching_era5_fwi',
-                    'message': 'Fetching ERA5 Data...',
-                    'detail': 'This may take up to 1 minute'
-                })
-                
-                # Call the calculation function
-                # Note: Ideally, Model_Prediction would accept a callback for progress updates
-                Model_Prediction.calculate_and_append_master(start_time, duration, mins_since_fire_start)
-                
-                yield send_sse_event('progress', {
-                    'stage': 'processing',
-                    'message': 'Processing grid...',
-                    'detail': 'Computing predictions'
-                })
-                
-                # Load the newly calculated data
-                with xr.open_dataset(master_file) as ds:
-                    ds_master = ds.load()
-                    model_inputs = ds_master.sel(
-                        s_time=start_time,
-                        duration_hours=slice(1, duration),
-                        fstart=mins_since_fire_start
-                    ).to_dataframe().reset_index()
-            
-            # --- Clean and Filter Data ---
-            yield send_sse_event('progress', {
-                'stage': 'filtering',
-                'message': 'Filtering data...',
-                'detail': 'Applying Portugal mask'
-            })
-            
-            model_inputs = model_inputs.dropna(subset=cols_to_check, how='all')
-            
-            # Filter to Portugal cells
-            portugal_cells = gpd.read_file('backend/utils/Data/Portugal_cells.gpkg')
-            portugal_cells = portugal_cells.to_crs('EPSG:4326')
-            
-            centroids = portugal_cells.geometry.centroid
-            valid_coords = set(zip(
-                centroids.y.round(1),
-                centroids.x.round(1)
-            ))
-            
-            mask = [
-                (round(lat, 1), round(lon, 1)) in valid_coords
-                for lat, lon in zip(model_inputs['latitude'], model_inputs['longitude'])
-            ]
-            model_inputs = model_inputs[mask]
-            
-            # --- Build Response ---
-            yield send_sse_event('progress', {
-                'stage': 'building_response',
-                'message': 'Building response...',
-                'detail': 'Organizing predictions'
-            })
-            
-            pred_col = 'linear_pred' if model_type == 'complex' else 'linear_pred_linear'
-            error_col = 'error_estimate' if model_type == 'complex' else 'error_estimate_linear'
-            input_var_cols = ['fuel_load', 'pct_3_8', 'pct_8p', 'wv100_kh', 'FWI_12h', 'DC_12h', 'Cape', 'HDW', 'wv_850', 'gT_8_7']
-            
-            predictions_by_duration = {}
-            total_cells = 0
-            successful_cells = 0
-            
-            unique_durations = sorted(model_inputs['duration_hours'].unique())
-            
-            for dur in unique_durations:
-                dur_int = int(dur)
-                df_dur = model_inputs[model_inputs['duration_hours'] == dur]
-                predictions_by_duration[dur_int] = []
-                
-                for _, row in df_dur.iterrows():
-                    total_cells += 1
-                    pred_value = row.get(pred_col)
-                    if pd.notna(pred_value):
-                        displacement = float(pred_value) * dur_int
-                        
-                        pred_entry = {
-                            'lat': float(row['latitude']),
-                            'lon': float(row['longitude']),
-                            'ros': float(pred_value),
-                            'displacement': displacement,
-                            'error_estimate': float(row.get(error_col, pred_value * 0.1)),  
-                            'input_vars': {}
-                        }
-                        
-                        for col in input_var_cols:
-                            val = row.get(col)
-                            pred_entry['input_vars'][col] = float(val) if pd.notna(val) else None
-                        
-                        predictions_by_duration[dur_int].append(pred_entry)
-                        successful_cells += 1
-            
-            # Calculate increments
-            increments_by_duration = {}
-            ros_increments_by_duration = {}
-            duration_list = sorted(predictions_by_duration.keys())
-            
-            for i, dur in enumerate(duration_list):
-                if i == 0:
-                    increments_by_duration[dur] = {
-                        (p['lat'], p['lon']): p['displacement']
-                        for p in predictions_by_duration[dur]
-                    }
-                    ros_increments_by_duration[dur] = {
-                        (p['lat'], p['lon']): p['ros']
-                        for p in predictions_by_duration[dur]
-                    }
-                else:
-                    prev_dur = duration_list[i - 1]
-                    prev_displacements = {
-                        (p['lat'], p['lon']): p['displacement']
-                        for p in predictions_by_duration[prev_dur]
-                    }
-                    prev_ros = {
-                        (p['lat'], p['lon']): p['ros']
-                        for p in predictions_by_duration[prev_dur]
-                    }
-                    increments_by_duration[dur] = {}
-                    ros_increments_by_duration[dur] = {}
-                    for p in predictions_by_duration[dur]:
-                        key = (p['lat'], p['lon'])
-                        prev_disp = prev_displacements.get(key, 0)
-                        increments_by_duration[dur][key] = p['displacement'] - prev_disp
-                        prev_ros_val = prev_ros.get(key, 0)
-                        ros_increments_by_duration[dur][key] = p['ros'] - prev_ros_val
-            
-            for dur in predictions_by_duration:
-                for p in predictions_by_duration[dur]:
-                    key = (p['lat'], p['lon'])
-                    p['increment'] = increments_by_duration[dur].get(key, p['displacement'])
-                    p['ros_increment'] = ros_increments_by_duration[dur].get(key, p['ros'])
-            
-            # Generate TIFF outputs
-            yield send_sse_event('progress', {
-                'stage': 'generating_tiff',
-                'message': 'Generating outputs...',
-                'detail': 'Creating TIFF files'
-            })
-            
-            df_slice = model_inputs.copy()
-            if pred_col in df_slice.columns:
-                df_slice['linear_pred_smoothed'] = df_slice[pred_col]
-                _generate_tiff_outputs(df_slice, duration, input_var_cols)
-            
-            # --- Send Final Result ---
-            yield send_sse_event('complete', {
-                'success': True,
-                'predictions_by_duration': predictions_by_duration,
-                'durations': duration_list,
-                'total_cells': total_cells,
-                'successful_cells': successful_cells,
-                'input_var_names': input_var_cols
-            })
+
+            for event_type, data in _run_prediction(start_time, duration, mins_since_fire_start, model_type):
+                yield send_sse_event(event_type, data)
             
         except Exception as e:
             import traceback
             traceback.print_exc()
             yield send_sse_event('error', {'message': str(e)})
     
-    return Response(
-        generate(),
+    headers = {
+        'Cache-Control': 'no-cache',
+        'Connection': 'keep-alive',
+        'X-Accel-Buffering': 'no',  # Disable nginx buffering
+        'Vary': 'Accept-Encoding'
+    }
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+
+    events = sse_with_heartbeat(generate())
+    if use_gzip:
+        body = gzip_sse_stream(events)
+    else:
+        body = (event.encode() for event in events)
+
+    response = Response(
+        stream_with_context(body),
         mimetype='text/event-stream',
-        headers={
-            'Cache-Control': 'no-cache',
-            'Connection': 'keep-alive',
-            'X-Accel-Buffering': 'no'  # Disable nginx buffering
-        }
+        headers=headers
     )
+    # Hand each chunk straight to the server so events are flushed as they are produced
+    response.direct_passthrough = True
+    return response
 
 
 # Keep the original endpoint for backwards compatibility
 @app.route('/api/predict-grid', methods=['POST'])
+@compress.compressed()
 def predict_grid():
     """
     Original prediction endpoint (non-SSE).
@@ -320,182 +595,24 @@ def predict_grid():
         data = request.get_json()
         datetime_str = data.get('datetime')
         model_type = data.get('model', 'complex')
-        mins_since_fire_start = data.get('f_start', 0)
-        duration = data.get('duration_p', 1)
-        
-        if duration > 24:
-            return jsonify({
-                'success': False,
-                'error': 'Duration cannot exceed 24 hours.'
-            }), 400
-        
-        start_time = pd.to_datetime(datetime_str)
-        
-        MIN_DATE = pd.Timestamp('2015-01-01')
-        three_months_ago = pd.Timestamp.now() - pd.DateOffset(months=3)
-        
-        if not (MIN_DATE <= start_time <= three_months_ago):
+        mins_since_fire_start = int(data.get('f_start', 0))
+        duration = int(data.get('duration_p', 1))
+
+        try:
+            start_time = _parse_inputs(datetime_str, duration)
+        except ValueError as e:
             return jsonify({
                 'success': False,
-                'error': f'Date must be between January 1st, 2015 and 3 months prior to the present. ({three_months_ago.date()}).'
+                'error': str(e)
             }), 400
-        
-        start_time = start_time.round('30min')
-        
-        master_file = "Data/Master_Table.nc"
-        ds_master = None
-        
-        if os.path.exists(master_file):
-            with xr.open_dataset(master_file) as ds:
-                ds_master = ds.load()
-        
-        data_exists = False
-        cols_to_check = ['fuel_load', 'pct_3_8', 'pct_8p', 
-                  'FWI_12h', 'log_pred', 'linear_pred', 
-                 'error_estimate', 'log_pred_linear', 'linear_pred_linear']
-        
-        if ds_master is not None:
-            valid = True
-            for dur in range(1, duration + 1):
-                try:
-                    df_slice = ds_master.sel(
-                        s_time=start_time,
-                        duration_hours=dur,
-                        fstart=mins_since_fire_start
-                    ).to_dataframe().reset_index()
-                    
-                    if not df_slice[cols_to_check].notna().any().any():
-                        valid = False
-                        break
-                except KeyError:
-                    valid = False
-                    break
-            
-            data_exists = valid
-        
-        if data_exists:
-            model_inputs = ds_master.sel(
-                s_time=start_time,
-                duration_hours=slice(1, duration),
-                fstart=mins_since_fire_start
-            ).to_dataframe().reset_index()
-        else:
-            Model_Prediction.calculate_and_append_master(start_time, duration, mins_since_fire_start)
-            
-            with xr.open_dataset(master_file) as ds:
-                ds_master = ds.load()
-                model_inputs = ds_master.sel(
-                    s_time=start_time,
-                    duration_hours=slice(1, duration),
-                    fstart=mins_since_fire_start
-                ).to_dataframe().reset_index()
-        
-        model_inputs = model_inputs.dropna(subset=cols_to_check, how='all')
-        
-        portugal_cells = gpd.read_file('backend/utils/Data/Portugal_cells.gpkg')
-        portugal_cells = portugal_cells.to_crs('EPSG:4326')
-        
-        centroids = portugal_cells.geometry.centroid
-        valid_coords = set(zip(
-            centroids.y.round(1),
-            centroids.x.round(1)
-        ))
-        
-        mask = [
-            (round(lat, 1), round(lon, 1)) in valid_coords
-            for lat, lon in zip(model_inputs['latitude'], model_inputs['longitude'])
-        ]
-        model_inputs = model_inputs[mask]
-        
-        pred_col = 'linear_pred' if model_type == 'complex' else 'linear_pred_linear'
-        error_col = 'error_estimate' if model_type == 'complex' else 'error_estimate_linear'
-        input_var_cols = ['fuel_load', 'pct_3_8', 'pct_8p', 'wv100_kh', 'FWI_12h', 'DC_12h', 'Cape', 'HDW', 'wv_850', 'gT_8_7']
-        
-        predictions_by_duration = {}
-        total_cells = 0
-        successful_cells = 0
-        
-        unique_durations = sorted(model_inputs['duration_hours'].unique())
-        
-        for dur in unique_durations:
-            dur_int = int(dur)
-            df_dur = model_inputs[model_inputs['duration_hours'] == dur]
-            predictions_by_duration[dur_int] = []
-            
-            for _, row in df_dur.iterrows():
-                total_cells += 1
-                pred_value = row.get(pred_col)
-                if pd.notna(pred_value):
-                    displacement = float(pred_value) * dur_int
-                    
-                    pred_entry = {
-                        'lat': float(row['latitude']),
-                        'lon': float(row['longitude']),
-                        'ros': float(pred_value),
-                        'displacement': displacement,
-                        'error_estimate': float(row.get(error_col, pred_value * 0.1)),  
-                        'input_vars': {}
-                    }
-                    
-                    for col in input_var_cols:
-                        val = row.get(col)
-                        pred_entry['input_vars'][col] = float(val) if pd.notna(val) else None
-                    
-                    predictions_by_duration[dur_int].append(pred_entry)
-                    successful_cells += 1
-        
-        increments_by_duration = {}
-        ros_increments_by_duration = {}
-        duration_list = sorted(predictions_by_duration.keys())
-        
-        for i, dur in enumerate(duration_list):
-            if i == 0:
-                increments_by_duration[dur] = {
-                    (p['lat'], p['lon']): p['displacement']
-                    for p in predictions_by_duration[dur]
-                }
-                ros_increments_by_duration[dur] = {
-                    (p['lat'], p['lon']): p['ros']
-                    for p in predictions_by_duration[dur]
-                }
-            else:
-                prev_dur = duration_list[i - 1]
-                prev_displacements = {
-                    (p['lat'], p['lon']): p['displacement']
-                    for p in predictions_by_duration[prev_dur]
-                }
-                prev_ros = {
-                    (p['lat'], p['lon']): p['ros']
-                    for p in predictions_by_duration[prev_dur]
-                }
-                increments_by_duration[dur] = {}
-                ros_increments_by_duration[dur] = {}
-                for p in predictions_by_duration[dur]:
-                    key = (p['lat'], p['lon'])
-                    prev_disp = prev_displacements.get(key, 0)
-                    increments_by_duration[dur][key] = p['displacement'] - prev_disp
-                    prev_ros_val = prev_ros.get(key, 0)
-                    ros_increments_by_duration[dur][key] = p['ros'] - prev_ros_val
-        
-        for dur in predictions_by_duration:
-            for p in predictions_by_duration[dur]:
-                key = (p['lat'], p['lon'])
-                p['increment'] = increments_by_duration[dur].get(key, p['displacement'])
-                p['ros_increment'] = ros_increments_by_duration[dur].get(key, p['ros'])
-        
-        df_slice = model_inputs.copy()
-        if pred_col in df_slice.columns:
-            df_slice['linear_pred_smoothed'] = df_slice[pred_col]
-            _generate_tiff_outputs(df_slice, duration, input_var_cols)
-        
-        return jsonify({
-            'success': True,
-            'predictions_by_duration': predictions_by_duration,
-            'durations': duration_list,
-            'total_cells': total_cells,
-            'successful_cells': successful_cells,
-            'input_var_names': input_var_cols
-        })
+
+        # Drain the pipeline; only the final payload matters here
+        result = None
+        for event_type, payload in _run_prediction(start_time, duration, mins_since_fire_start, model_type):
+            if event_type == 'complete':
+                result = payload
+
+        return Response(stream_with_context(stream_json(result)), mimetype='application/json')
         
     except Exception as e:
         print(f"Error in predict_grid: {str(e)}")
@@ -507,14 +624,15 @@ def predict_grid():
         }), 500
 
 
-def _generate_tiff_outputs(df_slice, max_duration, input_var_cols):
+def _generate_tiff_outputs(df_slice, max_duration, input_var_cols, output_dir='Data/Output', master_mtime=None):
     """
     Generate TIFF output files for predictions and input variables.
+    Durations whose files are already newer than the Master Table are skipped.
     """
     if df_slice.empty or 'linear_pred_smoothed' not in df_slice.columns:
         return
     
-    os.makedirs('Data/Output', exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
     
     if 'duration_hours' not in df_slice.columns:
         return
@@ -524,6 +642,19 @@ def _generate_tiff_outputs(df_slice, max_duration, input_var_cols):
     
     for duration in df_slice['duration_hours'].unique():
         df = df_slice[df_slice['duration_hours'] == duration]
+
+        output_filename = f'{output_dir}/ros_linear_pred_duration_{int(duration)}.tif'
+        output_filename_disp = f'{output_dir}/ros_displacement_duration_{int(duration)}.tif'
+        output_filenames_var = {
+            var_col: f'{output_dir}/input_{var_col}_duration_{int(duration)}.tif'
+            for var_col in input_var_cols if var_col in df.columns
+        }
+
+        expected_files = [output_filename, output_filename_disp, *output_filenames_var.values()]
+        if master_mtime is not None and all(
+            os.path.exists(f) and os.path.getmtime(f) >= master_mtime for f in expected_files
+        ):
+            continue
         
         lat_vals = np.sort(df['latitude'].unique())
         lon_vals = np.sort(df['longitude'].unique())
@@ -540,17 +671,15 @@ def _generate_tiff_outputs(df_slice, max_duration, input_var_cols):
             pixel_size_lat
         )
         
+        # Pixel of every row, computed once and reused for each raster of this duration
+        rows = np.searchsorted(lat_vals, df['latitude'].to_numpy())
+        cols = np.searchsorted(lon_vals, df['longitude'].to_numpy())
+
         data_grid = np.full((len(lat_vals), len(lon_vals)), np.nan)
-        
-        for i, lat in enumerate(lat_vals):
-            for j, lon in enumerate(lon_vals):
-                val = df[(df['latitude'] == lat) & (df['longitude'] == lon)]['linear_pred_smoothed']
-                if not val.empty:
-                    data_grid[i, j] = val.values[0]
+        data_grid[rows, cols] = df['linear_pred_smoothed'].to_numpy()
         
         data_grid_to_save = np.flipud(data_grid)
         
-        output_filename = f'Data/Output/ros_linear_pred_duration_{int(duration)}.tif'
         with rasterio.open(
             output_filename,
             'w',
@@ -566,7 +695,6 @@ def _generate_tiff_outputs(df_slice, max_duration, input_var_cols):
             dst.write(data_grid_to_save, 1)
         
         displacement_grid = np.flipud(data_grid * duration)
-        output_filename_disp = f'Data/Output/ros_displacement_duration_{int(duration)}.tif'
         with rasterio.open(
             output_filename_disp,
             'w',
@@ -581,21 +709,12 @@ def _generate_tiff_outputs(df_slice, max_duration, input_var_cols):
         ) as dst:
             dst.write(displacement_grid, 1)
         
-        for var_col in input_var_cols:
-            if var_col not in df.columns:
-                continue
-            
+        for var_col, output_filename_var in output_filenames_var.items():
             var_grid = np.full((len(lat_vals), len(lon_vals)), np.nan)
-            
-            for i, lat in enumerate(lat_vals):
-                for j, lon in enumerate(lon_vals):
-                    val = df[(df['latitude'] == lat) & (df['longitude'] == lon)][var_col]
-                    if not val.empty and pd.notna(val.values[0]):
-                        var_grid[i, j] = val.values[0]
+            var_grid[rows, cols] = df[var_col].to_numpy()
             
             var_grid_to_save = np.flipud(var_grid)
             
-            output_filename_var = f'Data/Output/input_{var_col}_duration_{int(duration)}.tif'
             with rasterio.open(
                 output_filename_var,
                 'w',
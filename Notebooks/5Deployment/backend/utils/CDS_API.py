@@ -4,12 +4,46 @@ Faz o download dos dados ERA5 necessários para calcular: FWI_12h_av, wv100_k_av
 """
 
 import cdsapi
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
 import xarray as xr
 
+# Clientes partilhados, criados na primeira chamada a get_clients()
+_cds_client = None
+_ewds_client = None
 
-def fetch_era5_data(year, month, day, hour):
+
+def get_clients():
+    """
+    Devolve os clientes CDS e EWDS, criados uma única vez por processo.
+    Os tokens são lidos do API_tokens.txt apenas na primeira chamada e as sessões HTTP são reutilizadas.
+
+    Returns
+    -------
+    tuple
+        (cds_client, ewds_client)
+    """
+    global _cds_client, _ewds_client
+
+    if _cds_client is None or _ewds_client is None:
+        token_file = Path("backend/utils/API_tokens.txt")
+
+        # Ler tokens
+        tokens = {}
+        with token_file.open() as f:
+            for line in f:
+                if "=" in line:
+                    key, value = line.strip().split("=", 1)
+                    tokens[key] = value
+
+        _cds_client = cdsapi.Client(url=tokens["CDS_URL"], key=tokens["CDS_KEY"])
+        _ewds_client = cdsapi.Client(url=tokens["EWDS_URL"], key=tokens["EWDS_KEY"])
+
+    return _cds_client, _ewds_client
+
+
+def fetch_era5_data(year, month, day, hour, on_ready=None):
     """
     Faz o download dos dados ERA5 necessários para variáveis de previsão de incêndio.
     Para cada hora pedida, obtém essa hora e as 3 horas seguintes.
@@ -24,6 +58,10 @@ def fetch_era5_data(year, month, day, hour):
         Dia (ex.: [10])
     hour : list
         Hora (ex.: [11, 12, 13])
+    on_ready : callable, opcional
+        Chamada como on_ready(nome, caminho) assim que cada ficheiro está disponível
+        (logo, se já existia; ao terminar o download, caso contrário), para que o
+        processamento de um ficheiro comece sem esperar pelos restantes
 
     Returns
     -------
@@ -31,23 +69,15 @@ def fetch_era5_data(year, month, day, hour):
         Caminhos dos ficheiros descarregados
     """
 
-    token_file = Path("backend/utils/API_tokens.txt")
-
-    # Ler tokens
-    tokens = {}
-    with token_file.open() as f:
-        for line in f:
-            if "=" in line:
-                key, value = line.strip().split("=", 1)
-                tokens[key] = value
-
-    # Criar clientes CDS
-    cds_client = cdsapi.Client(url=tokens["CDS_URL"], key=tokens["CDS_KEY"])
-    ewds_client = cdsapi.Client(url=tokens["EWDS_URL"], key=tokens["EWDS_KEY"])
+    # Clientes CDS (criados uma vez por processo)
+    cds_client, ewds_client = get_clients()
 
     output_folder = Path("Data")
     downloaded_files = {}
 
+    # Pedidos em falta: (cliente, dataset, pedido, destino), descarregados em paralelo no fim
+    pending_requests = []
+
     year_str = "".join(str(x) for x in year)
     month_str = "".join(str(x) for x in month)
     day_str = "".join(str(x) for x in day)
@@ -80,11 +110,12 @@ def fetch_era5_data(year, month, day, hour):
         }
 
         print(f"Requesting: {sl_filename}")
-        cds_client.retrieve(
+        pending_requests.append((
+            cds_client,
             "reanalysis-era5-single-levels",
             single_levels_request,
-            str(sl_target),
-        )
+            sl_target,
+        ))
 
     else:
         print("SL dataset already exists")
@@ -115,11 +146,12 @@ def fetch_era5_data(year, month, day, hour):
         }
 
         print(f"Requesting: {pl_filename}")
-        cds_client.retrieve(
+        pending_requests.append((
+            cds_client,
             "reanalysis-era5-pressure-levels",
             pressure_levels_request,
-            str(pl_target),
-        )
+            pl_target,
+        ))
 
     else:
         print("PL dataset already exists")
@@ -149,11 +181,12 @@ def fetch_era5_data(year, month, day, hour):
         }
 
         print(f"Requesting: {fwi_filename}")
-        ewds_client.retrieve(
+        pending_requests.append((
+            ewds_client,
             "cems-fire-historical-v1",
             fwi_request,
-            str(fwi_target),
-        )
+            fwi_target,
+        ))
 
     else:
         print("FWI dataset already exists")
@@ -183,17 +216,41 @@ def fetch_era5_data(year, month, day, hour):
         }
 
         print(f"Requesting: {land_filename}")
-        cds_client.retrieve(
+        pending_requests.append((
+            cds_client,
             "reanalysis-era5-land",
             land_request,
-            str(land_target),
-        )
+            land_target,
+        ))
 
     else:
         print("Land dataset already exists")
 
     downloaded_files["Land"] = land_target
 
+    # ==================== DOWNLOADS EM PARALELO ====================
+    # Ficheiros que já existiam ficam disponíveis de imediato
+    dataset_names = {target: name for name, target in downloaded_files.items()}
+    pending_targets = {target for _, _, _, target in pending_requests}
+    if on_ready is not None:
+        for name, target in downloaded_files.items():
+            if target not in pending_targets:
+                on_ready(name, target)
+
+    # Um pedido por dataset em simultâneo, para que as filas de espera do CDS/EWDS se sobreponham
+    if pending_requests:
+        with ThreadPoolExecutor(max_workers=len(pending_requests)) as executor:
+            futures = {
+                executor.submit(client.retrieve, dataset, request, str(target)): target
+                for client, dataset, request, target in pending_requests
+            }
+            for future in as_completed(futures):
+                future.result()
+                target = futures[future]
+                print(f"Downloaded: {target.name}")
+                if on_ready is not None:
+                    on_ready(dataset_names[target], target)
+
     return downloaded_files
 
 
@@ -2,7 +2,7 @@
 This script compiles meteorological and GIS data for fire analysis.
 It merges meteorological variables with GIS layers, applies spatial masks, 
 and calculates cumulative mean datasets over the requested duration.
-It now saves a NetCDF with meteo + GIS + mask applied, and skips calculations
+It now saves a NetCDF with meteo + GIS for the whole grid, and skips calculations
 if the requested times already exist.
 Uses modules:
 - Meteo_dataset: assemble meteorological datasets
@@ -13,12 +13,161 @@ import xarray as xr
 import pandas as pd
 import numpy as np
 from pathlib import Path
-from shapely.geometry import Point
+import shapely
 import geopandas as gpd
 import importlib
+import hashlib
+import os
+import threading
+import uuid
+from functools import lru_cache
 
 from . import Meteo_dataset
-importlib.reload(Meteo_dataset)
+
+# Reload only in development (notebooks), set DEV_RELOAD=1: in production it would re-execute
+# the module on every import and throw away its caches
+if os.environ.get("DEV_RELOAD"):
+    importlib.reload(Meteo_dataset)
+
+MASK_CACHE_DIR = Path("Data") / "mask_cache"
+
+# Masks already computed in this process, by grid key
+_mask_cache = {}
+
+# Serializes the FireData read-merge-write, so concurrent requests never drop each other's hours
+FIREDATA_LOCK = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def load_gis_dataset():
+    """
+    Load the GIS layers (fuel, slope, ...) into memory once per process.
+    The file is static, so every Compile_data call reuses the same dataset.
+    """
+    Gis_path = Path("backend/utils/Data/GIS_data.nc")
+    fallback_Gis_path = Path("utils/Data/GIS_data.nc")
+
+    if not Gis_path.exists():
+        Gis_path = fallback_Gis_path
+
+    with xr.open_dataset(Gis_path) as ds_GIS:
+        return ds_GIS.rename({"lat": "latitude", "lon": "longitude"}).load()
+
+
+def write_netcdf_atomic(ds, path, **kwargs):
+    """
+    Write a dataset to NetCDF through a temporary file and an atomic rename.
+    Readers never see a half-written file and the previous version stays intact if the write fails.
+    The temporary file name is unique per call, so concurrent writers never touch each other's file.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        ds.to_netcdf(tmp_path, **kwargs)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+@lru_cache(maxsize=8)
+def read_firedata_times(netcdf_path, mtime_ns):
+    """
+    valid_time axis of FireData (coordinate only, no data).
+    Cached per file version: the mtime is part of the key, so a rewrite invalidates it.
+    """
+    with xr.open_dataset(netcdf_path) as ds:
+        return pd.DatetimeIndex(ds.valid_time.values)
+
+
+@lru_cache(maxsize=8)
+def load_firedata_hours(netcdf_path, times, mtime_ns):
+    """
+    Load the given hours of FireData into memory, cached per (hours, file version).
+    Repeated requests for the same window reuse the loaded dataset without touching the file.
+    """
+    with xr.open_dataset(netcdf_path) as ds:
+        return ds.sel(valid_time=list(times)).load()
+
+
+def firedata_encoding(ds):
+    """
+    NetCDF encoding for FireData: float32 (enough for ERA5/GIS precision), zlib compression
+    and one chunk per hour, so selecting a few valid_time values only reads those slabs.
+    """
+    return {
+        var: {
+            "dtype": "float32",
+            "zlib": True,
+            "complevel": 3,
+            "chunksizes": tuple(1 if dim == "valid_time" else ds.sizes[dim] for dim in ds[var].dims),
+        }
+        for var in ds.data_vars
+    }
+
+
+def portugal_cells_path():
+    """Path of the Portugal cells GeoPackage (relative to the app or to backend/)."""
+    cells_path = Path("backend/utils/Data/Portugal_cells.gpkg")
+    fallback_cells_path = Path("utils/Data/Portugal_cells.gpkg")
+
+    if not cells_path.exists():
+        cells_path = fallback_cells_path
+    return cells_path
+
+
+@lru_cache(maxsize=1)
+def load_portugal_cells():
+    """
+    Read the Portugal cells GeoPackage once per process and return their union (EPSG:4326),
+    prepared for repeated point-in-polygon tests.
+    """
+    gdf_cells = gpd.read_file(portugal_cells_path())
+    if gdf_cells.crs.to_string() != "EPSG:4326":
+        gdf_cells = gdf_cells.to_crs("EPSG:4326")
+    cells_union = gdf_cells.geometry.union_all()
+
+    # Prepared geometry: later point-in-polygon tests use an internal index
+    shapely.prepare(cells_union)
+    return cells_union
+
+
+def portugal_mask(lat, lon):
+    """
+    Boolean mask (lat x lon) of the grid points inside the Portugal cells.
+
+    The ERA5 target grid is fixed, so the mask is cached in memory and on disk
+    (Data/mask_cache), keyed by a hash of the grid and of the GeoPackage mtime.
+    """
+    lat = np.ascontiguousarray(lat, dtype=np.float64)
+    lon = np.ascontiguousarray(lon, dtype=np.float64)
+    cells_mtime = str(portugal_cells_path().stat().st_mtime).encode()
+    key = hashlib.md5(lat.tobytes() + b"|" + lon.tobytes() + b"|" + cells_mtime).hexdigest()
+
+    if key in _mask_cache:
+        return _mask_cache[key]
+
+    cache_file = MASK_CACHE_DIR / f"{key}.npy"
+    if cache_file.exists():
+        mask_2d = np.load(cache_file)
+    else:
+        cells_union = load_portugal_cells()
+
+        lon_grid, lat_grid = np.meshgrid(lon, lat, indexing='xy')
+
+        # One vectorized test over the whole grid, no Point objects
+        print("Creating spatial mask...")
+        mask_2d = shapely.contains_xy(cells_union, lon_grid, lat_grid)
+
+        # Write to a temporary file and rename, so a partial cache file is never read
+        MASK_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_name(f"{key}.tmp.npy")
+        np.save(tmp_file, mask_2d)
+        os.replace(tmp_file, cache_file)
+
+    mask_2d.setflags(write=False)
+    _mask_cache[key] = mask_2d
+    return mask_2d
 
 
 def Compile_data(duration, mins_since_fire_start, start_time):
@@ -28,7 +177,7 @@ def Compile_data(duration, mins_since_fire_start, start_time):
     This function assembles meteorological data for the requested duration,
     enriches it with GIS variables (fuel, slope, etc.), applies a spatial mask
     for Portugal cells, and calculates cumulative mean datasets per hour.
-    Saves a NetCDF with meteo+GIS+mask and reuses existing data if possible.
+    Saves a NetCDF with meteo+GIS and reuses existing data if possible.
     
     Parameters
     ----------
@@ -54,115 +203,99 @@ def Compile_data(duration, mins_since_fire_start, start_time):
     netcdf_path = Path("Data") / "FireData_Complete.nc"
     netcdf_path.parent.mkdir(parents=True, exist_ok=True)
 
-    # ---------------------- Load existing dataset if present ----------------------
-    ds_complete = None
+    # ---------------------- Read existing times (coordinate only, no data) ----------------------
+    existing_times = None
     if netcdf_path.exists():
         try:
-            with xr.open_dataset(netcdf_path) as ds:
-                ds_complete = ds.load()
+            existing_times = read_firedata_times(netcdf_path, netcdf_path.stat().st_mtime_ns)
             print("Existing FireData NetCDF found.")
         except:
-            ds_complete = None
+            existing_times = None
 
     # ---------------------- Identify missing times ----------------------
-    if ds_complete is not None:
-        missing_times = [t for t in required_times if t not in ds_complete.valid_time]
+    if existing_times is not None:
+        missing_times = required_times.difference(existing_times)
     else:
-        missing_times = required_times.to_list()
+        missing_times = required_times
 
-    print("Missing times", missing_times)
+    print("Missing times", list(missing_times))
 
     # ---------------------- Case: all data exists ----------------------
-    if not missing_times:
-        with xr.open_dataset(netcdf_path) as ds_complete:
-            ds_filtered = ds_complete.sel(valid_time=required_times)
+    if len(missing_times) == 0:
+        # Only the requested hours are read from disk (or reused if already loaded)
+        ds_filtered = load_firedata_hours(netcdf_path, tuple(required_times), netcdf_path.stat().st_mtime_ns)
     else:
         # ---------------------- Assemble missing meteorological data ----------------------
         ds_meteo_missing = Meteo_dataset.assemble_meteorological_data(missing_times)
 
-        # ---------------------- Open GIS dataset ----------------------
-        Gis_path = Path("backend/utils/Data/GIS_data.nc")
-        fallback_Gis_path = Path("utils/Data/GIS_data.nc")
-
-        if not Gis_path.exists():
-            Gis_path = fallback_Gis_path
-        
-        with xr.open_dataset(Gis_path) as ds_GIS:
-            ds_GIS = ds_GIS.rename({"lat": "latitude", "lon": "longitude"})
-
-            # ---------------------- Extract year coordinate ----------------------
-            ds_meteo_missing = ds_meteo_missing.assign_coords(
-                year=("valid_time", ds_meteo_missing.valid_time.dt.year.values)
-            )
-
-            # ---------------------- Function to add yearly GIS variables ----------------------
-            def add_yearly_vars(ds, ds_GIS, var_names):
-                data_vars = {}
-                for var in var_names:
-                    yearly_data = []
-                    for year in ds.year.values:
-                        gis_year = ds_GIS.sel(year=int(year))[var]
-                        gis_interp = gis_year.interp(latitude=ds.latitude, longitude=ds.longitude, method="linear")
-                        yearly_data.append(gis_interp)
-                    data_vars[var] = xr.concat(yearly_data, dim="valid_time")
-                return ds.assign(**data_vars).drop_vars("year")
-
-            # ---------------------- Add GIS variables to dataset ----------------------
-            ds_meteo_missing = add_yearly_vars(ds_meteo_missing, ds_GIS, list(ds_GIS.data_vars))
-
-        # ---------------------- Load Portugal cells GeoPackage ----------------------
-        cells_path = Path("backend/utils/Data/Portugal_cells.gpkg")
-        fallback_cells_path = Path("utils/Data/Portugal_cells.gpkg")
-
-        if not cells_path.exists():
-            cells_path = fallback_cells_path
-
-        gdf_cells = gpd.read_file(cells_path)
-        if gdf_cells.crs.to_string() != "EPSG:4326":
-            gdf_cells = gdf_cells.to_crs("EPSG:4326")
-        cells_union = gdf_cells.geometry.union_all()
-
-        # ---------------------- Create spatial mask ----------------------
-        lon = ds_meteo_missing.longitude.values
-        lat = ds_meteo_missing.latitude.values
-        lon_grid, lat_grid = np.meshgrid(lon, lat, indexing='xy')
-        points = [Point(lon_val, lat_val) for lon_val, lat_val in zip(lon_grid.ravel(), lat_grid.ravel())]
-
-        print("Creating spatial mask... this may take a moment")
-        mask = np.array([cells_union.contains(pt) for pt in points])
-        mask_2d = mask.reshape(len(lat), len(lon))
-        mask_da = xr.DataArray(mask_2d, coords=[ds_meteo_missing.latitude, ds_meteo_missing.longitude], dims=["latitude", "longitude"])
-
-        # ---------------------- Apply mask ----------------------
-        ds_filtered_missing = ds_meteo_missing.where(mask_da)
-        print("Dataset filtered by spatial mask")
-
-        # ---------------------- Merge with existing dataset ----------------------
-        if ds_complete is not None:
-            ds_complete = xr.concat([ds_complete, ds_filtered_missing], dim="valid_time")
-            valid_times = pd.Index(ds_complete.valid_time.values)
-            ds_complete = ds_complete.sel(valid_time=~valid_times.duplicated())
-        else:
-            ds_complete = ds_filtered_missing
-
-        # ---------------------- Save updated NetCDF ----------------------
-        ds_complete.to_netcdf(netcdf_path)
-        print(f"Saved/updated FireData NetCDF at {netcdf_path}")
+        # ---------------------- GIS dataset (cached per process) ----------------------
+        ds_GIS = load_gis_dataset()
+
+        # ---------------------- Extract year coordinate ----------------------
+        ds_meteo_missing = ds_meteo_missing.assign_coords(
+            year=("valid_time", ds_meteo_missing.valid_time.dt.year.values)
+        )
+
+        # ---------------------- Function to add yearly GIS variables ----------------------
+        def add_yearly_vars(ds, ds_GIS, var_names):
+            # Interpolate every variable and year onto the grid once, then pick each timestep's year
+            gis_interp = ds_GIS[var_names].interp(latitude=ds.latitude, longitude=ds.longitude, method="linear")
+            gis_by_time = gis_interp.sel(year=ds.year.astype(int)).drop_vars("year")
+            gis_by_time = gis_by_time.transpose("valid_time", "latitude", "longitude")
+            return ds.assign(**{var: gis_by_time[var] for var in var_names}).drop_vars("year")
+
+        # ---------------------- Add GIS variables to dataset ----------------------
+        ds_meteo_missing = add_yearly_vars(ds_meteo_missing, ds_GIS, list(ds_GIS.data_vars))
+
+        # ---------------------- Merge with existing dataset and save ----------------------
+        # The file is re-read under the lock: another request may have added hours since
+        # existing_times was read, and those must be kept
+        with FIREDATA_LOCK:
+            ds_complete = None
+            if netcdf_path.exists():
+                with xr.open_dataset(netcdf_path) as ds:
+                    ds_complete = ds.load()
+
+            if ds_complete is not None:
+                stored_times = pd.DatetimeIndex(ds_complete.valid_time.values)
+                ds_complete = xr.concat([ds_complete, ds_meteo_missing], dim="valid_time")
+                valid_times = pd.Index(ds_complete.valid_time.values)
+                ds_complete = ds_complete.sel(valid_time=~valid_times.duplicated())
+            else:
+                stored_times = None
+                ds_complete = ds_meteo_missing
+
+            # Another request may already have stored every assembled hour: the file is then unchanged
+            if stored_times is not None and len(stored_times) == ds_complete.sizes["valid_time"]:
+                print("FireData NetCDF already holds these hours, skipping write")
+            else:
+                write_netcdf_atomic(ds_complete, netcdf_path, encoding=firedata_encoding(ds_complete))
+                print(f"Saved/updated FireData NetCDF at {netcdf_path}")
 
         ds_filtered = ds_complete.sel(valid_time=required_times)
 
-    # ---------------------- Calculate cumulative mean per duration ----------------------
-    mean_list = []
-    for dur in range(1, duration + 1):
-        ds_slice = ds_filtered.isel(valid_time=slice(0, dur))
-        ds_mean = ds_slice.mean(dim="valid_time")
-        ds_mean = ds_mean.assign_coords(duration_hours=dur)
-        mean_list.append(ds_mean)
+    # ---------------------- Keep only Portugal cells ----------------------
+    # Flatten the grid to the cells inside the spatial mask (cached per grid), so cells outside
+    # Portugal are never averaged, turned into rows or predicted
+    mask_2d = portugal_mask(ds_filtered.latitude.values, ds_filtered.longitude.values)
+    ds_cells = ds_filtered.stack(cell=("latitude", "longitude")).isel(cell=mask_2d.ravel())
+    print("Dataset filtered by spatial mask")
 
-    ds_mean_all = xr.concat(mean_list, dim="duration_hours")
+    # ---------------------- Calculate cumulative mean per duration ----------------------
+    # Mean of the first `dur` hours for every dur at once: running sum / running count of valid values
+    # (NaN are skipped, as in .mean())
+    ds_hours = ds_cells.isel(valid_time=slice(0, duration))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ds_mean_all = ds_hours.cumsum(dim="valid_time") / ds_hours.notnull().cumsum(dim="valid_time")
+
+    ds_mean_all = (
+        ds_mean_all.drop_vars("valid_time", errors="ignore")
+        .rename({"valid_time": "duration_hours"})
+        .assign_coords(duration_hours=np.arange(1, duration + 1))
+    )
 
     # ---------------------- Convert to DataFrame ----------------------
-    df_all = ds_mean_all.to_dataframe().reset_index()
+    df_all = ds_mean_all.to_dataframe(dim_order=["duration_hours", "cell"]).reset_index()
     df_all['s_time'] = start_time
     df_all['fstart'] = mins_since_fire_start
 
@@ -12,14 +12,27 @@ import xarray as xr
 from pathlib import Path
 import importlib
 import os
-import glob
+from concurrent.futures import ThreadPoolExecutor
 
 
 from . import CDS_API, Meteo_vars
 
-# Reload modules in case of updates
-importlib.reload(CDS_API)
-importlib.reload(Meteo_vars)
+# Reload modules in case of updates, only in development (notebooks), set DEV_RELOAD=1
+if os.environ.get("DEV_RELOAD"):
+    importlib.reload(CDS_API)
+    importlib.reload(Meteo_vars)
+
+
+def remove_files(paths):
+    """
+    Delete the given files, ignoring any that are already gone.
+    Used to clean up the temporary ERA5 downloads of a request.
+    """
+    for path in paths:
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
 
 
 def assemble_meteorological_data(required_times):
@@ -56,28 +69,33 @@ def assemble_meteorological_data(required_times):
     print(f"  Days:   {days}")
     print(f"  Hours:  {hours}")
 
-    era5_files = CDS_API.fetch_era5_data(years, months, days, hours)
+    # ---------------------- Download and process ERA5 data ----------------------
+    # Each file is opened, renamed and regridded as soon as it lands, while the
+    # remaining downloads (typically FWI, the slowest queue) are still running
+    preparers = {
+        'single_levels': Meteo_vars.prepare_single_levels,
+        'pressure_levels': Meteo_vars.prepare_pressure_levels,
+        'fwi': Meteo_vars.prepare_fwi,
+        'Land': Meteo_vars.prepare_land,
+    }
+    prepared = {}
+    era5_tmp_files = []
+
+    with ThreadPoolExecutor(max_workers=len(preparers)) as executor:
+        def start_processing(name, path):
+            era5_tmp_files.append(Path(path))
+            prepared[name] = executor.submit(preparers[name], path)
 
-    # ---------------------- Process downloaded data ----------------------
-    ds_SL, ds_PL, ds_FWI, ds_Land = Meteo_vars.prepare_datasets(
-        sl_file=era5_files.get('single_levels'),
-        pl_file=era5_files.get('pressure_levels'),  
-        fwi_file=era5_files.get('fwi'),
-        land_file=era5_files.get('Land')
-    )
+        CDS_API.fetch_era5_data(years, months, days, hours, on_ready=start_processing)
 
-    ds_SL = ds_SL.load()
-    ds_PL = ds_PL.load()
-    ds_FWI = ds_FWI.load()
-    ds_Land = ds_Land.load()
+        ds_SL, ds_PL, ds_FWI, ds_Land = (prepared[name].result() for name in preparers)
 
     ds_meteovars = Meteo_vars.calculate_weather_variables(ds_SL, ds_PL, ds_FWI, ds_Land)
     ds_meteovars = ds_meteovars.sel(valid_time=required_times)
-    if 'pressure_level' in ds_meteovars:
-        ds_meteovars = ds_meteovars.drop_vars('pressure_level')
 
-    for f in glob.glob("Data/ERA5*.nc"):
-        os.remove(f)
+    # Temporary ERA5 files are no longer needed. Deleted before returning, so a following request
+    # never finds a file that is about to disappear; only the files of this request are removed
+    remove_files(era5_tmp_files)
 
     # ---------------------- Return dataset ----------------------
     print(f"Prepared meteorological dataset for {len(required_times)} hours.")
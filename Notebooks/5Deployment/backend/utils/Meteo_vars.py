@@ -1,79 +1,142 @@
 import numpy as np
 import pandas as pd
 import xarray as xr
-from scipy.interpolate import griddata
+from scipy.spatial import Delaunay
+from scipy.sparse import csr_matrix
+from metpy.calc import saturation_vapor_pressure
 from metpy.units import units
-from metpy.calc import saturation_vapor_pressure, vapor_pressure, wind_speed
 from contextlib import nullcontext
+from functools import lru_cache
 
 def safe_open(path):
     return xr.open_dataset(path, engine="netcdf4") if path else nullcontext(None)
 
-def prepare_datasets(sl_file, pl_file, fwi_file, land_file, target_res=0.1):
+@lru_cache(maxsize=8)
+def target_grid(target_res=0.1):
     """
-    Prepare ERA5 Single Levels, Pressure Levels, FWI and ERA5-Land datasets.
-
-    Parameters:
-    -----------
-    sl_file : str
-        Path to ERA5 Single Levels NetCDF file.
-    pl_file : str
-        Path to ERA5 Pressure Levels NetCDF file.
-    fwi_file : str
-        Path to Fire Weather Index NetCDF file.
-    land_file : str
-        Path to ERA5-Land NetCDF file.
-    target_res : float
-        Target grid resolution in degrees (default: 0.1°).
-
-    Returns:
-    --------
-    ds_SL : xarray.Dataset
-    ds_PL : xarray.Dataset
-    ds_FWI : xarray.Dataset
-    ds_Land : xarray.Dataset
+    Portugal target grid for a given resolution, built once and reused.
+    Returns 1D lat (descending) / lon (ascending) axes and their 2D meshes as read-only arrays.
     """
+    lat_min, lat_max = 36.9, 43.0
+    lon_min, lon_max = -10.0, -6.0
+    lat_new = np.arange(lat_max, lat_min - target_res, -target_res)
+    lon_new = np.arange(lon_min, lon_max + target_res, target_res)
 
-    # ==================== LOAD DATASETS ====================
-    print("Loading datasets...")
-    with safe_open(sl_file) as ds_SL, \
-        safe_open(pl_file) as ds_PL, \
-        safe_open(fwi_file) as ds_FWI, \
-        safe_open(land_file) as ds_Land:
+    lon_grid, lat_grid = np.meshgrid(lon_new, lat_new)
 
+    for arr in (lat_new, lon_new, lat_grid, lon_grid):
+        arr.setflags(write=False)
+    return lat_new, lon_new, lat_grid, lon_grid
+
+def linear_interp_weights(points, xi):
+    """
+    Linear interpolation weights from scattered points to the target points xi,
+    the same scheme as griddata(method='linear'): Delaunay triangulation + barycentric weights.
+    Built once per set of points and reused for every time step.
+    Returns (weights, outside): a sparse (target points x source points) matrix holding the
+    3 barycentric weights of each target point, and which target points fall outside the triangulation.
+    """
+    tri = Delaunay(points)
+    simplex = tri.find_simplex(xi)
+    outside = simplex < 0
+
+    transform = tri.transform[simplex]
+    bary = np.einsum('nij,nj->ni', transform[:, :2], xi - transform[:, 2])
+    weights = np.column_stack((bary, 1 - bary.sum(axis=1)))
+    vertices = tri.simplices[simplex]
+
+    # Points outside the triangulation get no weights (their rows are set to NaN when applied)
+    inside = np.flatnonzero(~outside)
+    rows = np.repeat(inside, 3)
+    weights = csr_matrix(
+        (weights[inside].ravel(), (rows, vertices[inside].ravel())),
+        shape=(len(xi), len(points))
+    )
+    return weights, outside
+
+
+def apply_interp_weights(values, weights, outside):
+    """
+    Interpolate values (..., source points) with weights from linear_interp_weights; NaN outside.
+    Leading axes (e.g. time) are interpolated together in one sparse matrix product.
+    """
+    flat = values.reshape(-1, values.shape[-1])
+    out = (weights @ flat.T).T.reshape(values.shape[:-1] + (weights.shape[0],))
+    out[..., outside] = np.nan
+    return out
+
+
+def prepare_single_levels(sl_file, target_res=0.1):
+    """
+    Open, rename and interpolate the ERA5 Single Levels file to the target grid.
+    Returns a loaded xarray.Dataset (the file is closed on return).
+    Interpolated fields are kept as float32 (as for all prepare_* outputs): enough for ERA5
+    precision, and every later elementwise step moves half the bytes.
+    """
+    with safe_open(sl_file) as ds_SL:
         print(ds_SL)
-        print(ds_PL)
-        print(ds_FWI)
-        print(ds_Land)
 
-        # ==================== RENAME VARIABLES ====================
         ds_SL = ds_SL.rename({"t2m": "t_2m_K", "d2m": "d_2m_K", "u10": "u10_ms", "v10": "v10_ms", "cape": "cape", "swvl3": "sW_100"})
-        ds_PL = ds_PL.rename({"t": "t_K", "u": "u_ms", "v": "v_ms", "z": "gp_m2s2"})
-        ds_FWI = ds_FWI.rename({"fwinx": "FWI_12h", "drtcode": "DC_12h"})
-        ds_Land = ds_Land.rename({"t2m": "t_2m_K", "d2m": "d_2m_K", "u10": "u10_ms", "v10": "v10_ms"})
-
-        # ==================== DROP UNNECESSARY VARIABLES ====================
         if 'number' in ds_SL: ds_SL = ds_SL.drop_vars(['number'])
         if 'expver' in ds_SL: ds_SL = ds_SL.drop_vars(['expver'])
+
+        lat_new, lon_new, _, _ = target_grid(target_res)
+        ds_SL = ds_SL.interp(latitude=lat_new, longitude=lon_new, method='linear').astype(np.float32).load()
+
+    print(ds_SL)
+    return ds_SL
+
+
+def prepare_pressure_levels(pl_file, target_res=0.1):
+    """
+    Open, rename and interpolate the ERA5 Pressure Levels file to the target grid.
+    Returns a loaded xarray.Dataset (the file is closed on return).
+    """
+    with safe_open(pl_file) as ds_PL:
+        print(ds_PL)
+
+        ds_PL = ds_PL.rename({"t": "t_K", "u": "u_ms", "v": "v_ms", "z": "gp_m2s2"})
         if 'number' in ds_PL: ds_PL = ds_PL.drop_vars(['number'])
         if 'expver' in ds_PL: ds_PL = ds_PL.drop_vars(['expver'])
-        if 'surface' in ds_FWI: ds_FWI = ds_FWI.drop_vars(['surface'])
+
+        lat_new, lon_new, _, _ = target_grid(target_res)
+        ds_PL = ds_PL.interp(latitude=lat_new, longitude=lon_new, method='linear').astype(np.float32).load()
+
+    print(ds_PL)
+    return ds_PL
+
+
+def prepare_land(land_file, target_res=0.1):
+    """
+    Open, rename and interpolate the ERA5-Land file to the target grid.
+    Returns a loaded xarray.Dataset (the file is closed on return).
+    """
+    with safe_open(land_file) as ds_Land:
+        print(ds_Land)
+
+        ds_Land = ds_Land.rename({"t2m": "t_2m_K", "d2m": "d_2m_K", "u10": "u10_ms", "v10": "v10_ms"})
         if 'number' in ds_Land: ds_Land = ds_Land.drop_vars(['number'])
         if 'expver' in ds_Land: ds_Land = ds_Land.drop_vars(['expver'])
 
-        # ==================== CREATE TARGET GRID ====================
-        lat_min, lat_max = 36.9, 43.0
-        lon_min, lon_max = -10.0, -6.0
-        lat_new = np.arange(lat_max, lat_min - target_res, -target_res)
-        lon_new = np.arange(lon_min, lon_max + target_res, target_res)
+        lat_new, lon_new, _, _ = target_grid(target_res)
+        ds_Land = ds_Land.interp(latitude=lat_new, longitude=lon_new, method='linear').astype(np.float32).load()
+
+    print(ds_Land)
+    return ds_Land
+
+
+def prepare_fwi(fwi_file, target_res=0.1):
+    """
+    Open the Fire Weather Index file, expand it from daily to hourly and regrid it
+    to the target grid. Returns a loaded xarray.Dataset (the file is closed on return).
+    """
+    with safe_open(fwi_file) as ds_FWI:
+        print(ds_FWI)
 
-        lon_grid, lat_grid = np.meshgrid(lon_new, lat_new)
+        ds_FWI = ds_FWI.rename({"fwinx": "FWI_12h", "drtcode": "DC_12h"})
+        if 'surface' in ds_FWI: ds_FWI = ds_FWI.drop_vars(['surface'])
 
-        # ==================== INTERPOLATE ERA5 DATA ====================
-        print("Interpolating ERA5 datasets to 0.1° grid...")
-        ds_SL = ds_SL.interp(latitude=lat_new, longitude=lon_new, method='linear')
-        ds_PL = ds_PL.interp(latitude=lat_new, longitude=lon_new, method='linear')
-        ds_Land = ds_Land.interp(latitude=lat_new, longitude=lon_new, method='linear')
+        lat_new, lon_new, lat_grid, lon_grid = target_grid(target_res)
 
         # ==================== PREPARE FWI DATA ====================
         print("Regridding FWI dataset to match ERA5 grid...")
@@ -83,58 +146,43 @@ def prepare_datasets(sl_file, pl_file, fwi_file, land_file, target_res=0.1):
 
         ds_FWI = ds_FWI.assign_coords(longitude=(((ds_FWI.longitude + 180) % 360) - 180))
 
-        # Expandir FWI diário → horário
-        times_hourly = pd.date_range(
-            start=ds_FWI.valid_time.min().values,
-            end=ds_FWI.valid_time.max().values + pd.Timedelta(hours=23),
-            freq='h'
-        )
-        ds_FWI = ds_FWI.reindex(valid_time=times_hourly, method='ffill')
-
         # ==================== INTERPOLAÇÃO 2D CORRETA ====================
         print("Interpolating FWI to regular grid...")
 
         lat_points = ds_FWI['latitude'].values
         lon_points = ds_FWI['longitude'].values
 
-        fw_interp_list = []
-        dc_interp_list = []
-
-        for t in range(len(ds_FWI.valid_time)):
-            lat_grid_orig, lon_grid_orig = np.meshgrid(lat_points, lon_points, indexing='ij')
-
-            # FWI
-            fw_values = ds_FWI['FWI_12h'].isel(valid_time=t).values
-            valid_mask_fw = ~np.isnan(fw_values)
-            points_valid_fw = np.column_stack((lat_grid_orig.ravel()[valid_mask_fw.ravel()],
-                                            lon_grid_orig.ravel()[valid_mask_fw.ravel()]))
-            values_valid_fw = fw_values.ravel()[valid_mask_fw.ravel()]
-            interp_fw = griddata(
-                points=points_valid_fw,
-                values=values_valid_fw,
-                xi=(lat_grid, lon_grid),
-                method='linear',
-                fill_value=np.nan
-            )
-            fw_interp_list.append(interp_fw)
-
-            # DC
-            dc_values = ds_FWI['DC_12h'].isel(valid_time=t).values
-            valid_mask_dc = ~np.isnan(dc_values)
-            points_valid_dc = np.column_stack((lat_grid_orig.ravel()[valid_mask_dc.ravel()],
-                                            lon_grid_orig.ravel()[valid_mask_dc.ravel()]))
-            values_valid_dc = dc_values.ravel()[valid_mask_dc.ravel()]
-            interp_dc = griddata(
-                points=points_valid_dc,
-                values=values_valid_dc,
-                xi=(lat_grid, lon_grid),
-                method='linear',
-                fill_value=np.nan
-            )
-            dc_interp_list.append(interp_dc)
-
-        fw_interp_array = np.stack(fw_interp_list)
-        dc_interp_array = np.stack(dc_interp_list)
+        lat_grid_orig, lon_grid_orig = np.meshgrid(lat_points, lon_points, indexing='ij')
+        points_all = np.column_stack((lat_grid_orig.ravel(), lon_grid_orig.ravel()))
+
+        # Pesos de interpolação por padrão de NaN: a triangulação é feita uma vez por padrão
+        # (normalmente um só, a máscara terra/mar) e reutilizada em todos os passos de tempo
+        xi = np.column_stack((lat_grid.ravel(), lon_grid.ravel()))
+        weights_cache = {}
+
+        def regrid(values):
+            # (tempo, lat, lon) -> (tempo, grelha alvo): os passos de tempo com o mesmo padrão
+            # de NaN são interpolados todos de uma vez
+            n_times = len(values)
+            values = values.reshape(n_times, -1)
+            out = np.empty((n_times, len(xi)), dtype=np.float32)
+            patterns, inverse = np.unique(~np.isnan(values), axis=0, return_inverse=True)
+            for p, valid_mask in enumerate(patterns):
+                steps = np.flatnonzero(inverse.ravel() == p)
+                key = valid_mask.tobytes()
+                if key not in weights_cache:
+                    weights_cache[key] = linear_interp_weights(points_all[valid_mask], xi)
+                out[steps] = apply_interp_weights(values[steps][:, valid_mask], *weights_cache[key])
+            return out.reshape((n_times,) + lat_grid.shape)
+
+        # FWI e DC estão na mesma grelha de origem: são interpolados juntos, partilhando a
+        # triangulação e (com a mesma máscara) uma única passagem de interpolação
+        dims = ('valid_time', 'latitude', 'longitude')
+        fw_dc = regrid(np.concatenate([
+            ds_FWI['FWI_12h'].transpose(*dims).values,
+            ds_FWI['DC_12h'].transpose(*dims).values,
+        ]))
+        fw_interp_array, dc_interp_array = np.split(fw_dc, 2)
 
         ds_FWI_interp = xr.Dataset(
             data_vars={
@@ -148,30 +196,37 @@ def prepare_datasets(sl_file, pl_file, fwi_file, land_file, target_res=0.1):
             }
         )
 
-        ds_FWI = ds_FWI_interp
-
-        print(ds_SL)
-        print(ds_PL)
-        print(ds_FWI)
-        print(ds_Land)
-
-    return ds_SL, ds_PL, ds_FWI, ds_Land
-
-
-
-
-
-
-
-
-
+        # Expandir FWI diário → horário, depois da interpolação: cada dia é interpolado uma só vez
+        # em vez de 24 (o ffill repete valores, e a interpolação de valores repetidos é igual)
+        times_hourly = pd.date_range(
+            start=ds_FWI.valid_time.min().values,
+            end=ds_FWI.valid_time.max().values + pd.Timedelta(hours=23),
+            freq='h'
+        )
+        ds_FWI = ds_FWI_interp.reindex(valid_time=times_hourly, method='ffill')
 
+    print(ds_FWI)
+    return ds_FWI
 
 
 # ============================================================
 #            CALCULATE WEATHER VARIABLES (UPDATED)
 # ============================================================
 
+def saturation_vapor_pressure_pa(temperature_k):
+    """
+    Saturation vapour pressure (Pa) from a temperature DataArray (K), with MetPy's public API:
+    units are attached to the bare array only for the call, and a plain DataArray comes back.
+    Computed in float64: VPD is a difference of two close values, which float32 would not resolve.
+    """
+    temperature = units.Quantity(temperature_k.values.astype(np.float64), 'K')
+    return xr.DataArray(
+        saturation_vapor_pressure(temperature).m_as('Pa'),
+        coords=temperature_k.coords,
+        dims=temperature_k.dims
+    )
+
+
 def calculate_weather_variables(ds_SL, ds_PL, ds_FWI, ds_Land):
     """
     Calculate weather variables:
@@ -182,26 +237,31 @@ def calculate_weather_variables(ds_SL, ds_PL, ds_FWI, ds_Land):
     """
 
 
+    # ==================== NÍVEIS DE PRESSÃO ====================
+    # Cada nível é procurado uma vez e selecionado por posição para todas as variáveis;
+    # a coordenada escalar pressure_level é descartada para não passar para o resultado
+    level_index = ds_PL.indexes["pressure_level"]
+    ds_850 = ds_PL.isel(pressure_level=level_index.get_loc(850)).drop_vars("pressure_level")
+    ds_700 = ds_PL.isel(pressure_level=level_index.get_loc(700)).drop_vars("pressure_level")
+
     # ==================== WIND SPEED 850 hPa (km/h) ====================
     print("Computing wind speed at 850 hPa...")
 
-    u850 = ds_PL["u_ms"].sel(pressure_level=850) * units("m/s")
-    v850 = ds_PL["v_ms"].sel(pressure_level=850) * units("m/s")
-
-    # velocidade do vento (m/s)
-    wspd_850 = wind_speed(u850, v850)
+    u850 = ds_850["u_ms"]
+    v850 = ds_850["v_ms"]
 
-    # converter para km/h
-    wspd_850_kmh = wspd_850 * 3.6
+    # velocidade do vento (m/s) numa só passagem, convertida para km/h no próprio array
+    wspd_850_kmh = np.hypot(u850, v850)
+    wspd_850_kmh *= 3.6
 
     # ==================== VPD A 2m (ERA5-LAND) ====================
     print("Computando VPD a 2m para ERA5-Land...")
 
-    T2_land  = ds_Land["t_2m_K"] * units.kelvin
-    Td2_land = ds_Land["d_2m_K"] * units.kelvin
+    T2_land  = ds_Land["t_2m_K"]
+    Td2_land = ds_Land["d_2m_K"]
 
-    es_land = saturation_vapor_pressure(T2_land)
-    ea_land = saturation_vapor_pressure(Td2_land)
+    es_land = saturation_vapor_pressure_pa(T2_land)
+    ea_land = saturation_vapor_pressure_pa(Td2_land)
 
     vpd_land = (es_land - ea_land) 
 
@@ -209,11 +269,11 @@ def calculate_weather_variables(ds_SL, ds_PL, ds_FWI, ds_Land):
     print("Computando VPD a 2m para ERA5-SL...")
 
     # ERA5-SL vem em °C → converter para Kelvin
-    T2_sl  = (ds_SL["t_2m_K"]) * units.kelvin
-    Td2_sl = (ds_SL["d_2m_K"]) * units.kelvin
+    T2_sl  = ds_SL["t_2m_K"]
+    Td2_sl = ds_SL["d_2m_K"]
 
-    es_sl = saturation_vapor_pressure(T2_sl)
-    ea_sl = saturation_vapor_pressure(Td2_sl)
+    es_sl = saturation_vapor_pressure_pa(T2_sl)
+    ea_sl = saturation_vapor_pressure_pa(Td2_sl)
 
     vpd_sl = (es_sl - ea_sl) * 0.001
 
@@ -222,16 +282,12 @@ def calculate_weather_variables(ds_SL, ds_PL, ds_FWI, ds_Land):
 
     # ---- WIND SPEED 10m (km/h) ----
     # LAND
-    ws10_land = wind_speed(
-        ds_Land["u10_ms"] * units("m/s"),
-        ds_Land["v10_ms"] * units("m/s")
-    ) * 3.6
+    ws10_land = np.hypot(ds_Land["u10_ms"], ds_Land["v10_ms"])
+    ws10_land *= 3.6
 
     # SL
-    ws10_sl = wind_speed(
-        ds_SL["u10_ms"] * units("m/s"),
-        ds_SL["u10_ms"] * units("m/s")
-    ) * 3.6
+    ws10_sl = np.hypot(ds_SL["u10_ms"], ds_SL["u10_ms"])
+    ws10_sl *= 3.6
 
     # ---- HDW ----
     hdw_land = vpd_land * ws10_land
@@ -245,26 +301,16 @@ def calculate_weather_variables(ds_SL, ds_PL, ds_FWI, ds_Land):
     g = 9.80665  # m/s²
 
     # --- Temperatura em 850 e 700 hPa (K) ---
-    T850 = ds_PL["t_K"].sel(pressure_level=850)
-    T700 = ds_PL["t_K"].sel(pressure_level=700)
+    T850 = ds_850["t_K"]
+    T700 = ds_700["t_K"]
 
     # --- Geopotencial Φ (m²/s²) ---
-    phi850 = ds_PL["gp_m2s2"].sel(pressure_level=850)
-    phi700 = ds_PL["gp_m2s2"].sel(pressure_level=700)
+    phi850 = ds_850["gp_m2s2"]
+    phi700 = ds_700["gp_m2s2"]
 
-    # --- Conversão de geopotencial Φ para altura geopotencial Z (m) ---
-    Z850 = phi850 / g
-    Z700 = phi700 / g
-
-    # --- Diferenças ---
-    dT = T700 - T850   # K → equivalente a °C
-    dZ = Z700 - Z850   # m
-
-    # --- Gradiente em °C/km ---
-    temp_grad_C_per_km = (dT / dZ) * 1000.0
-
-    # Output final
-    gradT_850_700_C_per_km = temp_grad_C_per_km
+    # --- Gradiente em °C/km: (dT / dZ) * 1000 com Z = Φ / g, numa só expressão ---
+    # dT = T700 - T850 (K → equivalente a °C), dZ = (Φ700 - Φ850) / g (m)
+    gradT_850_700_C_per_km = (1000.0 * g) * (T700 - T850) / (phi700 - phi850)
 
     print("Gradiente calculado: C/km")
 
@@ -287,11 +333,8 @@ def calculate_weather_variables(ds_SL, ds_PL, ds_FWI, ds_Land):
         }
     )
 
-    print(ds_output)
+    ds_output = ds_output.astype(np.float32)
 
-    # Remove unidades MetPy
-    for var in ds_output.data_vars:
-        if hasattr(ds_output[var].data, 'magnitude'):
-            ds_output[var] = (ds_output[var].dims, ds_output[var].data.magnitude)
+    print(ds_output)
 
     return ds_output
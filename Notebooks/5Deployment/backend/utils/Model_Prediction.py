@@ -3,14 +3,227 @@ import numpy as np
 import pandas as pd
 import pickle
 import os
+import threading
+import traceback
+import netCDF4
+from xarray.backends.netCDF4_ import NETCDF4_PYTHON_LOCK
+from functools import lru_cache
+from sklearn.linear_model import LinearRegression, Ridge, Lasso, ElasticNet
+from concurrent.futures import ThreadPoolExecutor
 from . import Create_inputs
 import importlib
-importlib.reload(Create_inputs)
 
-def calculate_and_append_master(start_time, duration, mins_since_fire_start, master_file="Data/Master_Table.nc"):
+# Recarregar módulos alterados só em desenvolvimento (notebooks): em produção o reload
+# re-executaria o módulo a cada import e descartaria as suas caches
+if os.environ.get('DEV_RELOAD'):
+    importlib.reload(Create_inputs)
+
+MODEL_DIR = r'../../Models'
+XGBOOST_MODEL = os.path.join(MODEL_DIR, 'model_xgboost.pkl')
+XGBOOST_ERROR_MODEL = os.path.join(MODEL_DIR, 'model_xgboost_error.pkl')
+LINEAR_MODEL = os.path.join(MODEL_DIR, 'model_linear_ffs.pkl')
+LINEAR_ERROR_MODEL = os.path.join(MODEL_DIR, 'model_linear_error.pkl')
+
+# Coluna de model_inputs -> nome da feature no modelo XGBoost (as restantes mantêm o nome)
+RENAME_DICT_XGB = {
+    'duration_hours': 'duration_p',
+    'pct_8p': '8_ny_fir_p',
+    'pct_3_8': '3_8y_fir_p',
+    'fstart': 'f_start',
+    'FWI_12h': 'FWI_12h_av'
+}
+
+# Coluna de model_inputs -> feature do modelo linear que a usa sem transformação
+# (as duas coexistem: a original também é guardada no Master_Table)
+LINEAR_DIRECT_FEATURES = {
+    'HDW': 'HDW_av',
+    'wv_850': 'wv_850_av',
+    'gT_8_7': 'gT_8_7_av'
+}
+
+# Regressores cujo predict é exatamente X @ coef_ + intercept_ (tipos exatos, sem subclasses)
+LINEAR_SHORTCUT_TYPES = (LinearRegression, Ridge, Lasso, ElasticNet)
+
+# As novas fatias são escritas no próprio Master_Table: leituras e escritas passam por este lock
+MASTER_LOCK = threading.Lock()
+
+# s_time guardado como inteiro em segundos, para que qualquer hora de início possa ser
+# acrescentada ao ficheiro sem mudar as unidades
+S_TIME_ENCODING = {'units': 'seconds since 1970-01-01 00:00:00', 'dtype': 'int64'}
+
+# Thread onde a cadeia XGBoost corre em paralelo com o modelo linear
+_PREDICT_POOL = ThreadPoolExecutor(max_workers=1)
+
+
+@lru_cache(maxsize=None)
+def load_model(path):
+    """
+    Carrega um modelo (pickle) uma única vez por processo; as chamadas seguintes reutilizam-no.
+    """
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+@lru_cache(maxsize=None)
+def xgb_feature_names(path):
+    """
+    Nomes das features do modelo XGBoost, na ordem do modelo, lidos do booster uma única vez.
+    """
+    return tuple(load_model(path).get_booster().feature_names)
+
+
+def preload_models():
+    """
+    Carrega todos os modelos existentes no arranque da app, para que o primeiro
+    pedido não pague o custo de os desserializar.
+    """
+    for path in (XGBOOST_MODEL, XGBOOST_ERROR_MODEL, LINEAR_MODEL, LINEAR_ERROR_MODEL):
+        if os.path.exists(path):
+            load_model(path)
+
+
+def as_model_input(values):
+    """
+    Converte os dados de entrada de um modelo para float32 C-contíguo: cada linha fica
+    numa zona contígua de memória e move-se metade dos bytes face a float64.
+    """
+    return np.ascontiguousarray(values, dtype=np.float32)
+
+
+def predict_linear(linear_model, X):
+    """
+    Previsão do modelo linear.
+    Regressores lineares de saída única cuja previsão é exatamente X @ coef + intercept
+    (LINEAR_SHORTCUT_TYPES, sem função de ligação) são avaliados diretamente, evitando a cadeia
+    de validação do predict; pipelines, classificadores e os restantes modelos usam o predict normal.
+    """
+    if type(linear_model) in LINEAR_SHORTCUT_TYPES and np.ndim(linear_model.coef_) == 1:
+        X = np.asarray(X)
+        return X @ np.ravel(linear_model.coef_).astype(X.dtype, copy=False) + linear_model.intercept_
+    return linear_model.predict(X)
+
+
+def master_encoding(ds):
+    """
+    Encoding NetCDF do Master_Table: float32 (precisão suficiente para previsões e variáveis meteo,
+    metade dos bytes), compressão zlib (as células fora de Portugal são NaN e comprimem bem)
+    e um chunk por s_time, que é a unidade acrescentada em cada append.
+    """
+    encoding = {
+        var: {
+            'dtype': 'float32',
+            'zlib': True,
+            'complevel': 3,
+            'chunksizes': tuple(1 if dim == 's_time' else ds.sizes[dim] for dim in ds[var].dims),
+        }
+        for var in ds.data_vars
+    }
+    encoding['s_time'] = S_TIME_ENCODING
+    return encoding
+
+
+def append_to_master(ds_new, master_file):
+    """
+    Acrescenta as fatias de ds_new ao fim do Master_Table, no próprio ficheiro (s_time ilimitado):
+    só os dados novos são escritos.
+    Devolve False, sem alterar o ficheiro, quando não é possível acrescentar: ficheiro sem s_time
+    ilimitado, s_time que não são posteriores aos existentes, variáveis em falta, ou coordenadas
+    latitude/longitude/duration_hours/fstart que o ficheiro não tem. Nesse caso é preciso reescrevê-lo.
+    O ficheiro é aberto diretamente com netCDF4, por isso toma o mesmo lock global (netCDF-C + HDF5)
+    que o xarray usa nas leituras: a libhdf5 não é thread-safe e outras threads leem FireData
+    e o Master_Table ao mesmo tempo.
+    """
+    with NETCDF4_PYTHON_LOCK, netCDF4.Dataset(master_file, 'a') as nc:
+        if 's_time' not in nc.dimensions or not nc.dimensions['s_time'].isunlimited():
+            return False
+        if any(var not in nc.variables for var in ds_new.data_vars):
+            return False
+
+        # Os restantes eixos do ficheiro são fixos: a nova fatia tem de caber neles
+        axes = {}
+        for dim in ('latitude', 'longitude', 'duration_hours', 'fstart'):
+            axis = np.asarray(nc.variables[dim][:])
+            if not np.isin(ds_new[dim].values, axis).all():
+                return False
+            axes[dim] = axis
+
+        # Novos s_time nas unidades do ficheiro, e só depois dos existentes (o ficheiro fica ordenado)
+        time_var = nc.variables['s_time']
+        n_times = len(time_var)
+        new_times = np.asarray(netCDF4.date2num(
+            pd.to_datetime(ds_new['s_time'].values).to_pydatetime(),
+            time_var.units,
+            getattr(time_var, 'calendar', 'standard'),
+        ))
+        if n_times and new_times.min() <= time_var[n_times - 1]:
+            return False
+        if np.issubdtype(time_var.dtype, np.integer) and not np.array_equal(new_times, np.round(new_times)):
+            return False
+
+        ds_new = ds_new.reindex(axes)
+        new_slice = slice(n_times, n_times + len(new_times))
+        for var in ds_new.data_vars:
+            nc_var = nc.variables[var]
+            nc_var[new_slice] = ds_new[var].transpose(*nc_var.dimensions).values
+        time_var[new_slice] = new_times.astype(time_var.dtype)
+
+    return True
+
+
+def write_master(ds_new, master_file):
+    """
+    Grava as novas fatias no Master_Table: cria o ficheiro, acrescenta-as no próprio ficheiro
+    ou, se não for possível, reescreve-o. Quem chama tem de ter o MASTER_LOCK.
+    """
+    if not os.path.exists(master_file):
+        Create_inputs.write_netcdf_atomic(ds_new, master_file, encoding=master_encoding(ds_new), unlimited_dims=['s_time'])
+        print("Master_Table criado:", master_file)
+    elif append_to_master(ds_new, master_file):
+        # Só as novas fatias de s_time foram escritas
+        print("Master_Table atualizado:", master_file)
+    else:
+        with xr.open_dataset(master_file) as ds_master:
+            ds_master = ds_master.sortby('s_time')
+            ds_new = ds_new.sortby('s_time')
+
+            ds_combined = xr.concat([ds_master, ds_new], dim='s_time')
+            # Ler tudo antes de fechar o ficheiro, para não o reabrir durante a escrita
+            ds_combined = ds_combined.sortby('s_time').load()
+
+        # Reescrito com s_time ilimitado, para que as próximas fatias possam ser acrescentadas
+        Create_inputs.write_netcdf_atomic(ds_combined, master_file, encoding=master_encoding(ds_combined), unlimited_dims=['s_time'])
+        print("Master_Table atualizado:", master_file)
+
+
+def persist_master(ds_new, master_file):
+    """
+    Grava as novas fatias no Master_Table (write_master), serializado pelo MASTER_LOCK.
+    """
+    with MASTER_LOCK:
+        write_master(ds_new, master_file)
+
+
+def _persist_master_background(ds_new, master_file):
+    """
+    Corpo da thread de escrita em segundo plano. O MASTER_LOCK foi adquirido por quem lançou
+    a thread, para que nenhuma leitura do Master_Table passe à frente desta escrita, e é libertado
+    aqui no fim. Ninguém espera pelo resultado, por isso os erros são registados.
+    """
+    try:
+        write_master(ds_new, master_file)
+    except Exception:
+        print(f"Erro ao gravar o Master_Table {master_file}:")
+        traceback.print_exc()
+    finally:
+        MASTER_LOCK.release()
+
+
+def calculate_and_append_master(start_time, duration, mins_since_fire_start, master_file="Data/Master_Table.nc", background=False):
     """
     Calcula novos dados com Create_inputs.Compile_data e XGBoost, 
     e adiciona ao Master_Table.nc.
+    Devolve o Dataset com as novas fatias. Com background=True a escrita no Master_Table
+    corre numa thread e a função devolve logo que as previsões estão calculadas.
     """
 
     # ------------------- Calcular dados -------------------
@@ -18,46 +231,52 @@ def calculate_and_append_master(start_time, duration, mins_since_fire_start, mas
 
     model_inputs['fstart'] = mins_since_fire_start
 
+    model_inputs = model_inputs.sort_values(by=["duration_hours", "latitude", "longitude"])
+
     # ------------------- Previsões XGBoost -------------------
-    with open(r'../../Models/model_xgboost.pkl', 'rb') as f:
-        model = pickle.load(f)
-
-    rename_dict_xgb = {
-        'duration_hours': 'duration_p',
-        'pct_8p': '8_ny_fir_p',
-        'pct_3_8': '3_8y_fir_p',
-        'fstart': 'f_start',
-        'FWI_12h': 'FWI_12h_av'
-    }
+    model = load_model(XGBOOST_MODEL)
 
-    X = model_inputs.drop(columns=['latitude', 'longitude', 's_time']).rename(columns=rename_dict_xgb)
-    missing_cols = set(model.get_booster().feature_names) - set(X.columns)
-    if missing_cols:
-        raise ValueError(f"XGBoost missing columns: {missing_cols}")
-    X = X[model.get_booster().feature_names]
+    # Nome da feature no modelo -> coluna de origem em model_inputs
+    source_cols = {
+        RENAME_DICT_XGB.get(col, col): col
+        for col in model_inputs.columns if col not in ('latitude', 'longitude', 's_time')
+    }
+    feature_names = xgb_feature_names(XGBOOST_MODEL)
+    missing_cols = pd.Index(feature_names).difference(list(source_cols))
+    if len(missing_cols):
+        raise ValueError(f"XGBoost missing columns: {list(missing_cols)}")
 
-    # Fazer previsões
-    predictions = model.predict(X)
+    # Matriz de features pré-alocada (float32, C-contígua, a precisão que o XGBoost usa internamente),
+    # preenchida coluna a coluna sem cópias intermédias do DataFrame
+    X = np.empty((len(model_inputs), len(feature_names)), dtype=np.float32)
+    for j, name in enumerate(feature_names):
+        X[:, j] = model_inputs[source_cols[name]].to_numpy()
 
-    model_inputs['log_pred'] = predictions  # log scale
-    model_inputs['linear_pred'] = np.exp(predictions) - 1  # linear scale
+    error_model_xgb = load_model(XGBOOST_ERROR_MODEL)
 
-    model_inputs = model_inputs.sort_values(by=["duration_hours", "latitude", "longitude"])
+    def predict_xgb():
+        # Fazer previsões diretamente sobre o array (as colunas já estão na ordem do modelo):
+        # o XGBoost lê o buffer float32 sem cópia, sem passar por um DataFrame nem uma DMatrix
+        predictions = model.predict(X)
+        linear_pred = np.expm1(predictions)  # linear scale (exp(x) - 1 numa só passagem)
 
-    # ------------------- Error Estimation for XGBoost -------------------
-    with open(r'../../Models/model_xgboost_error.pkl', 'rb') as f:
-        error_model_xgb = pickle.load(f)
+        # ------------------- Error Estimation for XGBoost -------------------
+        linear_ros = as_model_input(linear_pred.reshape(-1, 1))
+        return predictions, linear_pred, error_model_xgb.predict(linear_ros)
 
-    linear_ros = model_inputs['linear_pred'].values.reshape(-1, 1)
-    model_inputs['error_estimate'] = error_model_xgb.predict(linear_ros)
+    # A cadeia XGBoost (modelo + erro) corre numa thread enquanto o modelo linear é avaliado nesta:
+    # são independentes e ambos libertam o GIL (OpenMP / BLAS). Só lê X, não toca em model_inputs
+    xgb_future = _PREDICT_POOL.submit(predict_xgb)
 
     # ------------------- Linear Model Predictions -------------------
-    with open(r'../../Models/model_linear_ffs.pkl', 'rb') as f:
-        linear_model = pickle.load(f)
+    linear_model = load_model(LINEAR_MODEL)
 
     # Signed log transformation function: sign * ln(|var| + 1)
+    # log1p escrito no próprio buffer de |x|, e o sinal copiado de x (sem arrays intermédios)
     def signed_log1p(x):
-        return np.sign(x) * np.log(np.abs(x) + 1)
+        a = np.abs(x)
+        np.log1p(a, out=a)
+        return np.copysign(a, x, out=a)
 
     # Create all required features for linear model
     model_inputs['duration_p'] = model_inputs['duration_hours'].values
@@ -73,14 +292,9 @@ def calculate_and_append_master(start_time, duration, mins_since_fire_start, mas
         model_inputs['Cape_av_log'] = signed_log1p(model_inputs['Cape'].values)
     
     # Direct mappings (no transformation)
-    if 'HDW' in model_inputs.columns:
-        model_inputs['HDW_av'] = model_inputs['HDW'].values
-    
-    if 'wv_850' in model_inputs.columns:
-        model_inputs['wv_850_av'] = model_inputs['wv_850'].values
-    
-    if 'gT_8_7' in model_inputs.columns:
-        model_inputs['gT_8_7_av'] = model_inputs['gT_8_7'].values
+    for col, feature in LINEAR_DIRECT_FEATURES.items():
+        if col in model_inputs.columns:
+            model_inputs[feature] = model_inputs[col]
 
     # Get the exact feature order from the model
     if hasattr(linear_model, 'feature_names_in_'):
@@ -98,37 +312,37 @@ def calculate_and_append_master(start_time, duration, mins_since_fire_start, mas
     print(f"Linear model expected feature order: {linear_features}")
     
     # Check which features are available
-    available_linear_features = [f for f in linear_features if f in model_inputs.columns]
-    missing_linear_features = set(linear_features) - set(available_linear_features)
+    missing_linear_features = pd.Index(linear_features).difference(model_inputs.columns)
     
-    if missing_linear_features:
-        print(f"Warning: Linear model missing columns: {missing_linear_features}")
+    if len(missing_linear_features):
+        print(f"Warning: Linear model missing columns: {list(missing_linear_features)}")
         model_inputs['log_pred_linear'] = np.nan
         model_inputs['linear_pred_linear'] = np.nan
     else:
         # Use the EXACT order from the model
-        X_linear = model_inputs[linear_features].copy()
-        X_linear = X_linear.fillna(0)
+        # NaN -> 0 preenchido no próprio array float32 (sem copy() + fillna() do DataFrame)
+        X_linear = as_model_input(model_inputs[linear_features].to_numpy())
+        np.copyto(X_linear, 0, where=np.isnan(X_linear))
+        X_linear = pd.DataFrame(X_linear, columns=linear_features, copy=False)
         
-        linear_predictions = linear_model.predict(X_linear)
+        linear_predictions = predict_linear(linear_model, X_linear)
         model_inputs['log_pred_linear'] = linear_predictions
-        model_inputs['linear_pred_linear'] = np.exp(linear_predictions) - 1
+        model_inputs['linear_pred_linear'] = np.expm1(linear_predictions)
 
     # ------------------- Error Estimation for Linear model -------------------
-    with open(r'../../Models/model_linear_error.pkl', 'rb') as f:
-        error_model_linear = pickle.load(f)
+    error_model_linear = load_model(LINEAR_ERROR_MODEL)
 
     # Use linear model's predictions, not XGBoost's
-    linear_ros_linear = model_inputs['linear_pred_linear'].values.reshape(-1, 1)
+    linear_ros_linear = as_model_input(model_inputs['linear_pred_linear'].values.reshape(-1, 1))
     model_inputs['error_estimate_linear'] = error_model_linear.predict(linear_ros_linear)
 
+    predictions, linear_pred, error_estimate = xgb_future.result()
+    model_inputs['log_pred'] = predictions  # log scale
+    model_inputs['linear_pred'] = linear_pred
+    model_inputs['error_estimate'] = error_estimate
+
     # ------------------- Transformar em xarray -------------------
     df = model_inputs.copy()
-    times = np.sort(df['s_time'].unique())
-    lats = np.sort(df['latitude'].unique())
-    lons = np.sort(df['longitude'].unique())
-    durations = np.sort(df['duration_hours'].unique())
-    fstarts = np.sort(df['fstart'].unique())
 
     dims = ('s_time', 'latitude', 'longitude', 'duration_hours', 'fstart')
     
@@ -138,42 +352,40 @@ def calculate_and_append_master(start_time, duration, mins_since_fire_start, mas
                  'log_pred_linear', 'linear_pred_linear', 'error_estimate_linear',
                  'DC_12h', 'Cape', 'HDW', 'wv_850', 'gT_8_7']
     
-    ds_new = xr.Dataset()
-    for var in variables:
-        ds_new[var] = xr.DataArray(
-            np.full((len(times), len(lats), len(lons), len(durations), len(fstarts)), np.nan),
-            coords={
-                's_time': times,
-                'latitude': lats,
-                'longitude': lons,
-                'duration_hours': durations,
-                'fstart': fstarts
-            },
-            dims=dims
-        )
-
-    for idx, row in df.iterrows():
-        t_idx = np.where(times == row['s_time'])[0][0]
-        lat_idx = np.where(lats == row['latitude'])[0][0]
-        lon_idx = np.where(lons == row['longitude'])[0][0]
-        dur_idx = np.where(durations == row['duration_hours'])[0][0]
-        fstart_idx = np.where(fstarts == row['fstart'])[0][0]
-
-        for var in variables:
-            if var in row.index and pd.notna(row[var]):
-                ds_new[var][t_idx, lat_idx, lon_idx, dur_idx, fstart_idx] = row[var]
+    # Coordenadas ordenadas e posição de cada linha em cada dimensão numa só passagem:
+    # factorize com sort=True devolve os códigos das categorias ordenadas (sem unique + sort + searchsorted)
+    coords = {}
+    index = []
+    for dim in dims:
+        codes, coords[dim] = pd.factorize(df[dim].to_numpy(), sort=True)
+        index.append(codes)
+    index = tuple(index)
+    shape = tuple(len(coords[dim]) for dim in dims)
 
-    # ------------------- Atualizar ou criar Master_Table -------------------
-    if os.path.exists(master_file):
-        with xr.open_dataset(master_file) as ds_master:
-            ds_master = ds_master.sortby('s_time')
-            ds_new = ds_new.sortby('s_time')
+    # Todas as variáveis num só array (variável, s_time, latitude, longitude, duration_hours, fstart),
+    # em float32 como no Master_Table, preenchido com uma única atribuição vetorizada;
+    # cada variável do Dataset é uma vista sobre ele (variáveis ausentes em df ficam NaN)
+    data = np.full((len(variables),) + shape, np.nan, dtype=np.float32)
+    data[(slice(None),) + index] = df.reindex(columns=variables).to_numpy(dtype=np.float32).T
 
-            ds_combined = xr.concat([ds_master, ds_new], dim='s_time')
-            ds_combined = ds_combined.sortby('s_time')
+    ds_new = xr.Dataset(
+        {var: (dims, data[i]) for i, var in enumerate(variables)},
+        coords=coords
+    )
 
-        ds_combined.to_netcdf(master_file)
-        print("Master_Table atualizado:", master_file)
+    # ------------------- Atualizar ou criar Master_Table -------------------
+    if background:
+        # Quem chama já pode usar ds_new enquanto o ficheiro é escrito. O lock é adquirido já aqui:
+        # quem ler o Master_Table (ou a sua data de modificação) a seguir espera pela escrita.
+        # A thread não é daemon para que uma escrita em curso não seja interrompida à saída do processo
+        MASTER_LOCK.acquire()
+        try:
+            threading.Thread(target=_persist_master_background, args=(ds_new, master_file)).start()
+        except BaseException:
+            MASTER_LOCK.release()
+            raise
     else:
-        ds_new.to_netcdf(master_file)
-        print("Master_Table criado:", master_file)
\ No newline at end of file
+        persist_master(ds_new, master_file)
+
+    return ds_new
+